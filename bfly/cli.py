@@ -175,6 +175,43 @@ def parseNumRange(num_arg):
     return list(range(int(start), int(end) + step, step))
 
 
+def pyramid():
+    '''
+    Build stored mip levels for a regular image stack
+    or for the datasets of an HDF5 source
+    '''
+    from bfly.logic import core
+    from bfly.logic import pyramid as builder
+
+    log.basicConfig(level=log.INFO)
+
+    parser = argparse.ArgumentParser(
+        description='Builds the mip levels of a butterfly datasource')
+    parser.add_argument('datapath', help='Path to the image stack or h5')
+    parser.add_argument(
+        '-l', '--levels', type=int, default=None,
+        help='Number of levels above full resolution '
+             '(default: until one tile covers each plane)')
+    parser.add_argument(
+        '-t', '--threads', type=int, default=os.cpu_count() or 1,
+        help='Number of planes, or HDF5 files, to build at once')
+    args = parser.parse_args()
+
+    c = core.Core()
+    datapath = os.path.realpath(os.path.expanduser(args.datapath))
+    c.create_datasource(datapath)
+    source = c.get_datasource(datapath)
+    kind = type(source).__name__
+
+    if kind == 'RegularImageStack':
+        levels = builder.build_images(source, args.levels, args.threads)
+    elif kind == 'HDF5DataSource':
+        levels = builder.build_hdf5(source, args.levels, args.threads)
+    else:
+        parser.error('%s already has mip levels or cannot store them' % kind)
+    log.info('Built %d mip levels for %s' % (levels, datapath))
+
+
 def query():
     from bfly.logic import core
     c = core.Core()
@@ -0,0 +1,303 @@
+'''A data source for chunked volumes in N5 or Zarr v2 folders'''
+
+import os
+import json
+import zlib
+import struct
+import numpy as np
+
+from .datasource import DataSource
+
+'''The metadata file of a Zarr array and of group attributes'''
+ZARR_ARRAY = '.zarray'
+ZARR_ATTRS = '.zattrs'
+
+'''The metadata file of an N5 dataset or group'''
+N5_ATTRS = 'attributes.json'
+
+'''The chunk codecs that can be read, by their Zarr or N5 names'''
+CODECS = {
+    None: 'raw',
+    'raw': 'raw',
+    'zlib': 'zlib',
+    'gzip': 'gzip',
+}
+
+'''The numpy dtypes of N5 data types, stored big endian'''
+N5_TYPES = {
+    'uint8': '>u1', 'uint16': '>u2', 'uint32': '>u4', 'uint64': '>u8',
+    'int8': '>i1', 'int16': '>i2', 'int32': '>i4', 'int64': '>i8',
+    'float32': '>f4', 'float64': '>f8',
+}
+
+
+def decompress(data, codec):
+    '''Decompress the bytes of one chunk
+
+    :param data: the bytes read from the chunk file
+    :param codec: 'raw', 'zlib' or 'gzip'
+    '''
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    return data
+
+
+def read_json(path):
+    '''Read a json file or return None if there is none'''
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def open_zarr(path):
+    '''Describe a Zarr v2 array
+
+    :param path: the folder of the array
+    :returns: a dictionary describing the array or None
+    '''
+    meta = read_json(os.path.join(path, ZARR_ARRAY))
+    if meta is None:
+        return None
+    compressor = meta.get('compressor')
+    codec = compressor.get('id') if compressor else None
+    if codec not in CODECS or meta.get('filters'):
+        raise IndexError("Zarr codec %s is not supported" % codec)
+    return {
+        'path': path,
+        'format': 'zarr',
+        'shape': meta['shape'],
+        'chunks': meta['chunks'],
+        'dtype': meta['dtype'],
+        'order': meta.get('order', 'C'),
+        'codec': CODECS[codec],
+        'fill': meta.get('fill_value') or 0,
+        'separator': meta.get('dimension_separator', '.'),
+    }
+
+
+def open_n5(path):
+    '''Describe an N5 dataset with its axes in (z, y, x) order
+
+    :param path: the folder of the dataset
+    :returns: a dictionary describing the dataset or None
+    '''
+    meta = read_json(os.path.join(path, N5_ATTRS))
+    if meta is None or 'dimensions' not in meta:
+        return None
+    compression = meta.get('compression', {'type': 'raw'})
+    codec = compression.get('type')
+    if codec not in CODECS or meta['dataType'] not in N5_TYPES:
+        raise IndexError("N5 codec %s is not supported" % codec)
+    return {
+        'path': path,
+        'format': 'n5',
+        'shape': meta['dimensions'][::-1],
+        'chunks': meta['blockSize'][::-1],
+        'dtype': N5_TYPES[meta['dataType']],
+        'order': 'C',
+        'codec': CODECS[codec],
+        'fill': 0,
+        'separator': '/',
+    }
+
+
+def open_array(path):
+    '''Describe a Zarr array or N5 dataset'''
+    return open_zarr(path) or open_n5(path)
+
+
+def scale_paths(path):
+    '''Find the arrays of each level of a multiscale group
+
+    :param path: the folder of the group
+    :returns: the list of array folders from full resolution
+    '''
+    attrs = read_json(os.path.join(path, ZARR_ATTRS)) or {}
+    if 'multiscales' in attrs:
+        datasets = attrs['multiscales'][0]['datasets']
+        return [os.path.join(path, d['path']) for d in datasets]
+    # N5 scale pyramids have a dataset in s0, s1 and so on
+    paths = []
+    while os.path.isdir(os.path.join(path, 's%d' % len(paths))):
+        paths.append(os.path.join(path, 's%d' % len(paths)))
+    return paths
+
+
+class ChunkStoreDataSource(DataSource):
+    '''A chunked volume data source
+
+    The datapath is the folder of a Zarr v2 array or an N5 dataset, or
+    of a multiscale group with one array for each level. Zarr groups
+    list their levels in the "multiscales" attribute, and N5 groups have
+    the levels in folders named s0, s1 and so on. Every array has the
+    axes (z, y, x) and chunks compressed with zlib, gzip or nothing.
+
+    Only the chunks that hold requested pixels are read, and they are
+    decompressed at the same time and kept in the tile cache.
+    '''
+
+    # Reading the metadata is as fast as reading an index
+    persist_index = False
+
+    def __init__(self, core, datapath):
+        self._levels = self.open_levels(datapath)
+        super(ChunkStoreDataSource, self).__init__(core, datapath)
+
+    def open_levels(self, path):
+        '''Describe the array of every level
+
+        :param path: the folder of an array or multiscale group
+        :returns: a list of array dictionaries from full resolution
+        '''
+        if not os.path.isdir(path):
+            raise IndexError("Chunk store %s must be a folder" % path)
+        level = open_array(path)
+        if level is not None:
+            levels = [level]
+        else:
+            levels = [open_array(p) for p in scale_paths(path)]
+        if not levels or None in levels:
+            raise IndexError("Chunk store %s has no arrays" % path)
+        for level in levels:
+            if len(level['shape']) != 3:
+                raise IndexError("Chunk store %s must be 3D" % path)
+            # The scale of the level along each axis
+            level['factors'] = [
+                int(2 ** round(np.log2(float(full) / max(part, 1))))
+                for full, part in zip(levels[0]['shape'], level['shape'])]
+        return levels
+
+    def index(self):
+        '''
+        @override
+        '''
+        [chunk_z, chunk_y, chunk_x] = self._levels[0]['chunks']
+        self.blocksize = (chunk_x, chunk_y)
+        self.max_zoom = len(self._levels) - 1
+        super(ChunkStoreDataSource, self).index()
+
+    def get_type(self):
+        '''
+        @override
+        '''
+        return np.dtype(self._levels[0]['dtype']).newbyteorder('=')
+
+    def chunk_path(self, level, index):
+        '''Get the file of a chunk
+
+        :param level: the dictionary describing the array
+        :param index: the (z, y, x) index of the chunk
+        '''
+        if level['format'] == 'n5':
+            index = index[::-1]
+        name = level['separator'].join(str(i) for i in index)
+        return os.path.join(level['path'], name)
+
+    def read_chunk(self, level, index):
+        '''Read and decompress a chunk without the cache
+
+        :param level: the dictionary describing the array
+        :param index: the (z, y, x) index of the chunk
+        :returns: the (z, y, x) chunk
+        '''
+        with open(self.chunk_path(level, index), 'rb') as f:
+            data = f.read()
+        shape = level['chunks']
+        if level['format'] == 'n5':
+            # Chunks at the edges may be smaller than the rest
+            [mode, ndim] = struct.unpack('>HH', data[:4])
+            shape = struct.unpack('>%dI' % ndim, data[4:4 + 4 * ndim])[::-1]
+            # Chunks in varlength mode also give their number of values
+            data = data[4 + 4 * ndim + (4 if mode == 1 else 0):]
+        chunk = np.frombuffer(decompress(data, level['codec']),
+                              dtype=level['dtype'])
+        chunk = chunk.reshape(shape, order=level['order'])
+        return chunk.astype(self.dtype, copy=False)
+
+    def load_chunk(self, w, index):
+        '''Get a chunk from the cache or from its file
+
+        :param w: the level of the array
+        :param index: the (z, y, x) index of the chunk
+        :returns: the (z, y, x) chunk or None if it is not stored
+        '''
+        level = self._levels[w]
+        cache_index = (self._datapath, 'chunk', w) + tuple(index)
+        if cache_index not in self._core._cache:
+            # Chunks that were never written hold the fill value
+            if not os.path.isfile(self.chunk_path(level, index)):
+                return None
+        # The chunk files are compressed on disk already
+        return self.load_cached(
+            cache_index, lambda: self.read_chunk(level, index),
+            self.is_pinned(w), persist=False)
+
+    def load_subvolume(self, x0, x1, y0, y1, z0, z1, w):
+        '''
+        @override
+        '''
+        s = 2 ** w
+        shape = (z1 - z0, (y1 - y0) // s, (x1 - x0) // s)
+        # Read the nearest level and subsample the rest
+        level_w = max(k for k, level in enumerate(self._levels)
+                      if max(level['factors'][1:]) <= s)
+        level = self._levels[level_w]
+        [fz, fy, fx] = level['factors']
+        # Coordinates in the level of every output pixel
+        coords = [np.arange(z0, z1) // fz,
+                  (y0 + s * np.arange(shape[1])) // fy,
+                  (x0 + s * np.arange(shape[2])) // fx]
+        result = np.zeros(shape, dtype=self.dtype)
+        result[:] = level['fill']
+
+        # The chunks holding any output pixel
+        inside = [c[(c >= 0) & (c < n)] for c, n in zip(coords,
+                                                        level['shape'])]
+        ranges = [np.unique(c // n) for c, n in zip(inside, level['chunks'])]
+        chunks = [(int(cz), int(cy), int(cx)) for cz in ranges[0]
+                  for cy in ranges[1] for cx in ranges[2]]
+
+        def copy_chunk(index):
+            chunk = self.load_chunk(level_w, index)
+            if chunk is None:
+                return
+            # Output pixels inside this chunk and their chunk pixels
+            where = []
+            for c, i, n, m in zip(coords, index, level['chunks'],
+                                  chunk.shape):
+                found = np.flatnonzero((c >= i * n) & (c < i * n + m))
+                where.append((found, c[found] - i * n))
+            [(oz, sz), (oy, sy), (ox, sx)] = where
+            result[np.ix_(oz, oy, ox)] = chunk[np.ix_(sz, sy, sx)]
+
+        if len(chunks) == 1:
+            copy_chunk(chunks[0])
+        else:
+            # Read and decompress the chunks at the same time
+            list(self._core.block_pool.map(copy_chunk, chunks))
+        return np.moveaxis(result, 0, -1)
+
+    def load_cutout(self, x0, x1, y0, y1, z, w):
+        '''
+        @override
+        '''
+        return self.load_subvolume(x0, x1, y0, y1, z, z + 1, w)[:, :, 0]
+
+    def load(self, x, y, z, w):
+        '''
+        @override
+        '''
+        [bx, by] = self.blocksize[:2]
+        s = 2 ** w
+        return self.load_cutout(x * bx * s, (x + 1) * bx * s,
+                                y * by * s, (y + 1) * by * s, z, w)
+
+    def get_boundaries(self):
+        '''
+        @override
+        '''
+        [size_z, size_y, size_x] = self._levels[0]['shape']
+        return (size_x, size_y, size_z)
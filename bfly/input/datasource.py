@@ -5,9 +5,25 @@ import h5py
 from bfly.logic import settings
 import numpy as np
 from bfly.logic import core
+from bfly.logic import sidecar
+from bfly.logic import pyramid
+
+# Codec flags to decode a jpeg at half, quarter or eighth size
+REDUCED_DECODE = {
+    1: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    3: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+REDUCED_EXTENSIONS = ('jpg', 'jpeg')
 
 class DataSource(object):
 
+    # Whether the index can be saved to a sidecar file
+    persist_index = True
+
+    # Whether loads keep what they read in the tile cache
+    cache_reads = True
+
     def __init__(self, core, datapath):
         '''
         '''
@@ -20,6 +36,9 @@ class DataSource(object):
         self.max_zoom = -1
         self.blocksize = (0, 0)
         self._color_map = None
+        # Keep tiles at or above this mip level pinned in the cache
+        self.pin_level = settings.CACHE_PIN_LEVELS.get(
+            datapath, settings.CACHE_PIN_LEVEL)
 
     def index(self):
         '''
@@ -31,49 +50,283 @@ class DataSource(object):
     def get_type(self):
         return self.load(0,0,0,0).dtype
 
+    def index_sources(self):
+        '''
+        Files and folders whose changes invalidate the index
+        '''
+        return [self._datapath]
+
+    def index_state(self):
+        '''
+        Get the results of the index as a json dictionary
+        '''
+        return {
+            'dtype': np.dtype(self.dtype).str,
+            'blocksize': [int(b) for b in self.blocksize],
+            'max_zoom': int(self.max_zoom),
+        }
+
+    def restore_index(self, state):
+        '''
+        Set the results of the index from a json dictionary
+        '''
+        self.dtype = np.dtype(state['dtype'])
+        self.blocksize = tuple(state['blocksize'])
+        self.max_zoom = state['max_zoom']
+
+    def load_index(self):
+        '''
+        Restore the index from its sidecar file if
+        none of the indexed files have changed.
+        '''
+        if not self.persist_index:
+            return False
+        kind = type(self).__name__
+        state = sidecar.load(self._datapath, kind, self.index_sources())
+        if state is None:
+            return False
+        self.restore_index(state)
+        return True
+
+    def save_index(self):
+        '''
+        Save the index to its sidecar file
+        '''
+        if not self.persist_index:
+            return
+        kind = type(self).__name__
+        sidecar.save(self._datapath, kind, self.index_sources(),
+                     self.index_state())
+
     def load_cutout(self, x0, x1, y0, y1, z, w):
         '''
         Load a cutout from a plane
         '''
-        scale = float(2 ** w)
-        blockshape = np.array(self.blocksize)
-        x0y0 = np.array([x0,y0]) // scale
-        x1y1 = np.array([x1,y1]) // scale
-        top_left = np.floor(x0y0 / blockshape).astype(int)
-        lo_right = np.ceil(x1y1 / blockshape).astype(int)
-        origin = top_left * blockshape
-        [left,top] = (x0y0 - origin).astype(int)
-        [right,down] = (x1y1 - origin).astype(int)
-        gridshape = lo_right-top_left
-        grid = np.indices(gridshape).T
-
-        cutshape = blockshape*grid.shape[:-1]
-        cutout = np.zeros(cutshape, dtype=self.dtype)
-        fixed = [z,w]
-        for row in grid:
-            for where in row:
-                here = top_left + where
-                [i0,j0] = blockshape*(where)
-                [i1,j1] = blockshape*(where+1)
-                one_tile = list(here)+fixed
-                tile = self.load(*one_tile)
-                cutout[j0:j1,i0:i1] = tile
-        return cutout[top:down,left:right]
-
-    def load(self, cur_path, w):
+        scale = 2 ** w
+        [bx, by] = [int(b) for b in self.blocksize[:2]]
+        # Bounds of the cutout at the mip level
+        [i0, j0] = [int(x0 // scale), int(y0 // scale)]
+        [i1, j1] = [int(x1 // scale), int(y1 // scale)]
+        cutout = np.zeros((j1 - j0, i1 - i0), dtype=self.dtype)
+        # All blocks overlapping the cutout
+        blocks = [(x, y)
+                  for y in range(j0 // by, -(-j1 // by))
+                  for x in range(i0 // bx, -(-i1 // bx))]
+
+        def copy_block(where):
+            [x, y] = where
+            tile = self.load(x, y, z, w)
+            # Copy only the part of the block inside the cutout
+            [left, top] = [max(i0, x * bx), max(j0, y * by)]
+            right = min(i1, x * bx + tile.shape[1])
+            down = min(j1, y * by + tile.shape[0])
+            if right <= left or down <= top:
+                return
+            cutout[top - j0:down - j0, left - i0:right - i0] = \
+                tile[top - y * by:down - y * by, left - x * bx:right - x * bx]
+
+        if len(blocks) == 1:
+            copy_block(blocks[0])
+        else:
+            # Read and decode the blocks at the same time
+            list(self._core.block_pool.map(copy_block, blocks))
+        return cutout
+
+    def load_subvolume(self, x0, x1, y0, y1, z0, z1, w):
+        '''
+        Load a cutout of many planes with one read, or
+        return None if the format can only read planes.
+        The result has one plane for each z on the last axis.
+        '''
+        return None
+
+    def is_pinned(self, w):
+        '''
+        Whether tiles at mip level w stay pinned in the cache
+        '''
+        return self.pin_level is not None and w >= self.pin_level
+
+    def load_cached(self, key, loader, pinned=False, persist=True):
+        '''
+        Get a tile from the memory or disk cache,
+        or call the loader and cache the new tile.
+        Only tiles that persist use the disk cache.
+        '''
+        tile = self._core._cache.get(key)
+        if tile is not None:
+            return tile
+
+        # Concurrent requests for one tile share a single load
+        return self._core._flights.do(
+            key, lambda: self._load_missing(key, loader, pinned, persist))
+
+    def _load_missing(self, key, loader, pinned, persist):
+        disk_cache = self._core._disk_cache if persist else None
+        tile = None
+        if disk_cache is not None:
+            stamp = self.cache_stamp(key)
+            tile = disk_cache.get(key, stamp)
+        if tile is None:
+            tile = loader()
+            if disk_cache is not None:
+                disk_cache.set(key, tile, stamp)
+
+        # The cache evicts old tiles to fit this one
+        self._core._cache.set(key, tile, pinned)
+        return tile
+
+    def cache_stamp(self, key):
+        '''
+        The modification time and size of the file or folder
+        a tile key starts with, or None if it names no path.
+        '''
+        source = key[0] if isinstance(key, tuple) and key else None
+        if not isinstance(source, str):
+            return None
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load(self, cur_path, w, pinned=None):
         '''
         Loads this file from the data path.
         '''
+        if pinned is None:
+            pinned = self.is_pinned(w)
 
         cache_index = (cur_path, w)
+        return self.load_cached(
+            cache_index, lambda: self.read_file(cur_path, w), pinned)
+
+    def block_path(self, x, y, z, w):
+        '''
+        Path to the file of a block stored at mip level w,
+        or None if the block is not stored in its own file.
+        '''
+        return None
+
+    def block_file(self, x, y, z, w):
+        '''
+        Path to the stored file of a block that exists,
+        or None if the block is not stored in its own file.
+        '''
+        cur_path = self.block_path(x, y, z, w)
+        if cur_path is None or not os.path.isfile(cur_path):
+            return None
+        return cur_path
+
+    def can_reduce(self, cur_path):
+        '''
+        Whether the codec of this file can decode at reduced size.
+        '''
+        tile_ext = cur_path.rpartition('.')[2].lower()
+        if tile_ext not in REDUCED_EXTENSIONS or self.dtype != np.uint8:
+            return False
+        # The codec shrinks instead of the configured resize method
+        return settings.REDUCED_DECODE
+
+    def shrink(self, image, factor):
+        '''
+        Make an image a factor smaller with the configured method.
+        '''
+        if factor == 1:
+            return image
+        # We will use subsampling for all requests right now for speed
+        if settings.ALWAYS_SUBSAMPLE or self.dtype == np.uint32:
+            # Subsample to preserve accuracy for segmentations
+            # and copy so the cache does not keep the full image
+            return np.ascontiguousarray(image[::factor, ::factor])
+        shape = (-(-image.shape[1] // factor), -(-image.shape[0] // factor))
+        return cv2.resize(image, shape,
+                          interpolation=settings.IMAGE_RESIZE_METHOD)
 
-        # Check if image in cache
-        if cache_index in self._core._cache:
-            # Move most recently accesed items to the top
-            self._core._cache[cache_index] = self._core._cache.pop(cache_index)
-            print('Loading from cache!')
-            return self._core._cache[cache_index]
+    def block_counts(self):
+        '''
+        Number of blocks along x and y at full resolution
+        '''
+        [bx, by] = self.blocksize[:2]
+        [size_x, size_y] = self.get_boundaries()[:2]
+        return (-(-int(size_x) // int(bx)), -(-int(size_y) // int(by)))
+
+    def derive(self, x, y, z, w):
+        '''
+        Build a block at mip level w from the four blocks
+        at mip level w-1, which may come from the cache.
+        Uncached stored jpeg blocks are instead decoded
+        directly at the reduced size of level w.
+        '''
+        cache_index = (self._datapath, 'derived', x, y, z, w)
+        loader = self.reduce_loader(x, y, z, w)
+        if loader is None:
+            loader = lambda: self.merge_children(x, y, z, w)
+        return self.load_cached(cache_index, loader, self.is_pinned(w))
 
+    def child_blocks(self, x, y, w, level):
+        '''
+        The blocks at a finer level inside a block at level w
+        as (dx, dy, x, y) with their offsets in the block.
+        '''
+        across = 2 ** (w - level)
+        [nx, ny] = self.block_counts()
+        # Number of blocks at the finer level
+        [nx, ny] = [-(-nx // 2 ** level), -(-ny // 2 ** level)]
+        return [(dx, dy, across * x + dx, across * y + dy)
+                for dy in range(across) for dx in range(across)
+                if across * x + dx < nx and across * y + dy < ny]
+
+    def merge_children(self, x, y, z, w):
+        '''
+        Halve the four blocks at mip level w-1 into one block.
+        '''
+        tiles = {}
+        for dx, dy, cx, cy in self.child_blocks(x, y, w, w - 1):
+            tiles[dx, dy] = self.load(cx, cy, z, w - 1)
+        canvas = pyramid.combine(tiles, self.blocksize, self.dtype)
+        return self.shrink(canvas, 2)
+
+    def reduce_loader(self, x, y, z, w):
+        '''
+        A loader decoding the stored jpeg blocks under a block at
+        their reduced size, or None if they cannot all be reduced.
+        '''
+        # Decode from the last stored level up to eight times smaller
+        level = max(self.max_zoom, w - max(REDUCED_DECODE), 0)
+        reduced = w - level
+        if reduced < 1 or reduced > max(REDUCED_DECODE):
+            return None
+        across = 2 ** reduced
+        [bx, by] = [int(b) for b in self.blocksize[:2]]
+        if bx % across or by % across:
+            return None
+        paths = {}
+        for dx, dy, cx, cy in self.child_blocks(x, y, w, level):
+            cur_path = self.block_path(cx, cy, z, level)
+            if cur_path is None or not self.can_reduce(cur_path):
+                return None
+            paths[dx, dy] = cur_path
+        shape = (bx // across, by // across)
+
+        def reduce_children():
+            tiles = {}
+            cache = self._core._cache
+            for where, cur_path in paths.items():
+                tile = cache.get((cur_path, 0))
+                if tile is not None:
+                    # Shrink blocks that are decoded already
+                    tile = self.shrink(tile, across)
+                else:
+                    # The codec shrinks each block while decoding it
+                    tile = self.read_file(cur_path, reduced)
+                tiles[where] = tile
+            return pyramid.combine(tiles, shape, self.dtype, across)
+        return reduce_children
+
+    def read_file(self, cur_path, w):
+        '''
+        Reads and resizes this file without the cache.
+        '''
         # Load image from given path, check extension
         tile_ext = cur_path.rpartition('.')[2]
         if tile_ext == 'hdf5':
@@ -81,40 +334,17 @@ class DataSource(object):
                 datasets = []
                 f.visit(datasets.append)
                 tmp_image = f[datasets[0]][()]
+        elif w > 0 and self.can_reduce(cur_path):
+            # Let the codec skip most of the work for smaller images
+            reduced = min(w, max(REDUCED_DECODE))
+            tmp_image = cv2.imread(cur_path, REDUCED_DECODE[reduced])
+            w -= reduced
         else:
-            print('Current path', cur_path)
             tmp_image = cv2.imread(cur_path, 0)
 
-        # Resize if necessary, then also store to cache
+        # Resize if necessary
         if w > 0:
-            # We will use subsampling for all requests right now for speed
-            if settings.ALWAYS_SUBSAMPLE or self.dtype == np.uint32:
-                # Subsample to preserve accuracy for segmentations
-                tmp_image = tmp_image[::2 ** w, ::2 ** w]
-            else:
-                factor = 0.5 ** w
-                tmp_image = cv2.resize(
-                    tmp_image,
-                    (0,
-                     0),
-                    fx=factor,
-                    fy=factor,
-                    interpolation=settings.IMAGE_RESIZE_METHOD)
-
-        self._core._current_cache_size += tmp_image.size
-
-        # If we don't care to exceed the max cache size temporarily:
-        # self._core._cache[cur_path] = cv2.imread(cur_path, 0)
-        # self._core._current_cache_size += self._core._cache[cur_path].size
-
-        # Remove items in cache until everything fits
-        while self._core._current_cache_size > self._core._max_cache_size:
-            oldest_item = list(self._core._cache.keys())[0]
-            self._core._current_cache_size -= self._core._cache[
-                oldest_item].size
-            del self._core._cache[oldest_item]
-
-        self._core._cache[cache_index] = tmp_image
+            tmp_image = self.shrink(tmp_image, 2 ** w)
 
         return tmp_image
 
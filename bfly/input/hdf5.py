@@ -6,7 +6,8 @@ import json
 import logging
 from rh_logger import logger
 import numpy as np
-from . import settings
+from bfly.logic import settings
+from bfly.logic.handles import HandlePool
 
 from .datasource import DataSource
 
@@ -23,6 +24,50 @@ K_DEPTH = 'depth'
 
 K_DTYPE = 'dtype'
 
+'''The JSON dictionary key for the number of stored mip levels'''
+K_LEVELS = 'levels'
+
+'''Slots of the chunk cache hash table, a prime far above its chunks'''
+RDCC_NSLOTS = 10007
+
+'''Largest subsampling step to read densely and subsample in memory'''
+MAX_DENSE_STEP = 4
+
+
+def scale_path(dataset_path, w):
+    '''Get the path to the dataset of a stored mip level
+
+    :param dataset_path: the path to the full resolution dataset
+    :param w: the mip level above full resolution
+    '''
+    return '%s-w=%d' % (dataset_path, w)
+
+
+def count_levels(fd, dataset_path):
+    '''Count the stored mip levels written by bfly_pyramid
+
+    :param fd: the open HDF5 file
+    :param dataset_path: the path to the full resolution dataset
+    '''
+    levels = 0
+    while scale_path(dataset_path, levels + 1) in fd:
+        levels += 1
+    return levels
+
+
+def open_file(filename):
+    '''Open an HDF5 file to read with a chunk cache from the settings
+
+    :param filename: the path to the HDF5 file
+    '''
+    return h5py.File(filename, 'r', rdcc_w0=1,
+                     rdcc_nbytes=settings.HDF5_CHUNK_CACHE,
+                     rdcc_nslots=RDCC_NSLOTS)
+
+
+'''The open HDF5 files shared by all datasources'''
+FILES = HandlePool(open_file, settings.HDF5_HANDLES)
+
 class HDF5DataSource(DataSource):
     '''An HDF5 data source
 
@@ -37,13 +82,42 @@ class HDF5DataSource(DataSource):
     system is implicit, starting at 0, 0, 0.
     '''
 
+    # Cutouts are read directly without the tile cache
+    cache_reads = False
+
     def __init__(self, core, datapath):
-        self._dataset = self.loadFolder(datapath)
-        if not self._dataset:
+        self._filenames = self.checkFolder(datapath)
+        if not self._filenames:
             warn = "HDF5 path %s must point to valid h5" % datapath
             raise IndexError(warn)
         super(HDF5DataSource, self).__init__(core, datapath)
 
+    def checkFolder(self, path):
+        '''Find the HDF5 files, only reading their signatures
+
+        :param path: an h5 file or a json file describing h5 files
+        :returns: the list of h5 filenames or False
+        '''
+        if path.endswith('.json'):
+            result = json.load(open(path, "r"))
+            if isinstance(result, dict):
+                result = [result]
+            if not isinstance(result, list):
+                return False
+            for d in result:
+                if not isinstance(d, dict) or K_FILENAME not in d:
+                    return False
+                if K_DATASET_PATH not in d:
+                    return False
+                if not h5py.is_hdf5(d[K_FILENAME]):
+                    return False
+            return [d[K_FILENAME] for d in result]
+
+        elif path.endswith('.h5'):
+            return [path] if h5py.is_hdf5(path) else False
+        else:
+            return False
+
     def loadFolder(self,path):
         if path.endswith('.json'):
             result = json.load(open(path, "r"))
@@ -52,19 +126,21 @@ class HDF5DataSource(DataSource):
             for d in result:
                 if K_Z_OFFSET not in d:
                     d[K_Z_OFFSET] = 0
-                with h5py.File(d[K_FILENAME]) as fd:
+                with FILES.open(d[K_FILENAME]) as fd:
                     d[K_DEPTH] = fd[d[K_DATASET_PATH]].shape[0]
+                    d[K_LEVELS] = count_levels(fd, d[K_DATASET_PATH])
                     self._dtype = fd[d[K_DATASET_PATH]].dtype
             return result
 
         elif path.endswith('.h5'):
-            with h5py.File(path, "r") as fd:
+            with FILES.open(path) as fd:
                 key0 = list(fd.keys())[0]
                 self._dtype = fd[key0].dtype
                 return [{
                     K_FILENAME : path,
                     K_DATASET_PATH : key0,
                     K_DEPTH: fd[key0].shape[0],
+                    K_LEVELS: count_levels(fd, key0),
                     K_Z_OFFSET: 0,
                 }]
         else:
@@ -74,12 +150,42 @@ class HDF5DataSource(DataSource):
         '''
         @override
         '''
-        with h5py.File(self._dataset[0][K_FILENAME], "r") as fd:
+        self._dataset = self.loadFolder(self._datapath)
+        with FILES.open(self._dataset[0][K_FILENAME]) as fd:
             dataset = fd[self._dataset[0][K_DATASET_PATH]]
             self.blocksize = dataset.shape[1:][::-1]
+        # The planes of all files after their z offsets
+        self._size_z = max(d[K_Z_OFFSET] + d[K_DEPTH] for d in self._dataset)
+
+        # Only use mip levels stored for every file
+        self.max_zoom = min(d[K_LEVELS] for d in self._dataset)
 
         super(HDF5DataSource, self).index()
 
+    def index_sources(self):
+        '''
+        @override
+        '''
+        return [self._datapath] + self._filenames
+
+    def index_state(self):
+        '''
+        @override
+        '''
+        state = super(HDF5DataSource, self).index_state()
+        state['dataset'] = self._dataset
+        state['size_z'] = int(self._size_z)
+        return state
+
+    def restore_index(self, state):
+        '''
+        @override
+        '''
+        super(HDF5DataSource, self).restore_index(state)
+        self._dataset = state['dataset']
+        self._size_z = state['size_z']
+        self._dtype = self.dtype
+
     def get_plane_info(self, z):
         '''Get the filename, dataset path and z-index for a given plane
 
@@ -94,35 +200,91 @@ class HDF5DataSource(DataSource):
                 return d[K_FILENAME], d[K_DATASET_PATH], z-z_offset
         return (None, None, None)
 
+    def read_planes(self, filename, dataset_path, planes, bounds, w, out,
+                    first=0):
+        '''Read a cutout of some planes of one dataset
+
+        :param filename: the HDF5 file with the dataset
+        :param dataset_path: the path of the full resolution dataset
+        :param planes: the slice of planes to read from the dataset
+        :param bounds: the full resolution x0, x1, y0, y1 of the cutout
+        :param w: the mip level of the cutout
+        :param out: the (y, x, z) array to fill with the cutout
+        :param first: the plane of out for the first plane read
+        '''
+        [x0, x1, y0, y1] = bounds
+        # Read the nearest stored level and subsample the rest
+        level = min(w, max(self.max_zoom, 0))
+        if level > 0:
+            dataset_path = scale_path(dataset_path, level)
+        [s, step] = [2 ** level, 2 ** (w - level)]
+        with FILES.open(filename) as fd:
+            ds = fd[dataset_path]
+            if step == 1:
+                # Read all planes at once into one preallocated buffer
+                [top, left] = [y0 // s, x0 // s]
+                bottom = min(y1 // s, ds.shape[1], top + out.shape[0])
+                right = min(x1 // s, ds.shape[2], left + out.shape[1])
+                if bottom <= top or right <= left:
+                    return
+                depth = planes.stop - planes.start
+                cutout = np.empty((depth, bottom - top, right - left),
+                                  dtype=out.dtype)
+                ds.read_direct(cutout, np.s_[planes, top:bottom, left:right])
+            elif step <= MAX_DENSE_STEP:
+                # Read whole chunks at once and subsample in memory,
+                # as strided reads are much slower in HDF5
+                cutout = ds[planes, y0//s:y1//s, x0//s:x1//s]
+                cutout = cutout[:, ::step, ::step]
+            else:
+                cutout = ds[planes, y0//s:y1//s:step, x0//s:x1//s:step]
+            cutout = cutout[:, :out.shape[0], :out.shape[1]]
+            [depth, height, width] = cutout.shape
+            out[:height, :width, first:first + depth] = \
+                np.moveaxis(cutout, 0, -1)
+
     def load_cutout(self, x0, x1, y0, y1, z, w):
         '''
         @override
         '''
         filename, dataset_path, z_idx = self.get_plane_info(z)
-        result = np.zeros(((y1- y0) / (2**w), (x1-x0) / (2**w)), dtype=self._dtype)
+        shape = ((y1 - y0) // (2**w), (x1 - x0) // (2**w))
+        result = np.zeros(shape + (1,), dtype=self._dtype)
         if filename is not None:
-            with h5py.File(filename, "r") as fd:
-                ds = fd[dataset_path]
-                cutout = ds[z_idx, y0:y1:(2**w), x0:x1:(2**w)]
-                result[:cutout.shape[0], :cutout.shape[1]] = cutout
+            self.read_planes(filename, dataset_path, slice(z_idx, z_idx + 1),
+                             (x0, x1, y0, y1), w, result)
+        return result[:, :, 0]
+
+    def load_subvolume(self, x0, x1, y0, y1, z0, z1, w):
+        '''
+        @override
+        '''
+        shape = ((y1 - y0) // (2**w), (x1 - x0) // (2**w))
+        # The planes are last, as in the stacked planes of Core.get
+        result = np.zeros(shape + (z1 - z0,), dtype=self._dtype)
+        for d in self._dataset:
+            # The planes of the cutout inside this file
+            first = max(z0, d[K_Z_OFFSET])
+            last = min(z1, d[K_Z_OFFSET] + d[K_DEPTH])
+            if first >= last:
+                continue
+            planes = slice(first - d[K_Z_OFFSET], last - d[K_Z_OFFSET])
+            self.read_planes(d[K_FILENAME], d[K_DATASET_PATH], planes,
+                             (x0, x1, y0, y1), w, result, first - z0)
         return result
 
     def load(self, x, y, z, w, segmentation=False):
         '''
         @override
         '''
-        (bx,by) = self.blocksize
-        filename, dataset_path, z_idx = self.get_plane_info(z)
-        if filename is None:
-            return np.zeros((by / (2 ** w),
-                             bx / (2**w)), dtype=self._dtype)
-
-        with h5py.File(filename, "r") as fd:
-            dataset = fd[dataset_path]
-            return dataset[z, y:y+by:(2 ** w), x:x+bx:(2 ** w)]
+        (bx,by) = self.blocksize[:2]
+        s = 2 ** w
+        return self.load_cutout(x * bx * s, (x + 1) * bx * s,
+                                y * by * s, (y + 1) * by * s, z, w)
 
     def get_boundaries(self):
-        with h5py.File(self._dataset[0][K_FILENAME], "r") as fd:
-            dataset = fd[self._dataset[0][K_DATASET_PATH]]
-            self.blocksize = dataset.shape[::-1]
-        return self.blocksize
+        '''
+        @override
+        '''
+        [size_x, size_y] = self.blocksize[:2]
+        return (size_x, size_y, self._size_z)
@@ -0,0 +1,135 @@
+'''A memory mapped data source for numpy and raw volumes'''
+
+import os
+import json
+import numpy as np
+
+from .datasource import DataSource
+
+'''The JSON dictionary key for the raw file, relative to the JSON file'''
+K_RAW = 'raw'
+
+'''The JSON dictionary key for the (z, y, x) shape of the volume'''
+K_SHAPE = 'shape'
+
+'''The JSON dictionary key for the numpy dtype of the volume'''
+K_DTYPE = 'dtype'
+
+'''The JSON dictionary key for the bytes before the volume in the file'''
+K_OFFSET = 'offset'
+
+
+class MemmapDataSource(DataSource):
+    '''A memory mapped data source
+
+    The datapath is either a .npy file or a .json file with a dictionary
+    describing a raw volume in C order with the following keys:
+
+    raw: the name of the raw file, relative to the .json file
+    shape: the [z, y, x] shape of the volume
+    dtype: the numpy dtype of the volume, such as "<u4"
+    offset (optional): the bytes before the volume in the file
+
+    Cutouts are views of the mapped file, so only the pages holding
+    the requested pixels are read, and the operating system caches them.
+    '''
+
+    # Opening the map is as fast as reading an index
+    persist_index = False
+
+    # The operating system caches the pages that are read
+    cache_reads = False
+
+    def __init__(self, core, datapath):
+        self._volume = self.open_volume(datapath)
+        super(MemmapDataSource, self).__init__(core, datapath)
+
+    def open_volume(self, path):
+        '''Map a volume without reading it
+
+        :param path: a .npy file or a .json file describing a raw file
+        :returns: a read only (z, y, x) numpy memmap
+        '''
+        if path.endswith('.npy'):
+            volume = np.load(path, mmap_mode='r')
+        elif path.endswith('.json'):
+            with open(path, 'r') as f:
+                header = json.load(f)
+            if not isinstance(header, dict) or K_RAW not in header:
+                raise IndexError("JSON path %s has no raw volume" % path)
+            raw_path = os.path.join(os.path.dirname(path), header[K_RAW])
+            volume = np.memmap(raw_path, dtype=np.dtype(header[K_DTYPE]),
+                               mode='r', offset=int(header.get(K_OFFSET, 0)),
+                               shape=tuple(header[K_SHAPE]))
+        else:
+            raise IndexError("Memmap path %s must be .npy or .json" % path)
+
+        # A single image is a volume of one plane
+        if volume.ndim == 2:
+            volume = volume[np.newaxis]
+        if volume.ndim != 3:
+            raise IndexError("Memmap path %s must hold a 3D volume" % path)
+        return volume
+
+    def index(self):
+        '''
+        @override
+        '''
+        [size_z, size_y, size_x] = self._volume.shape
+        self.blocksize = (size_x, size_y)
+        self.max_zoom = 0
+        super(MemmapDataSource, self).index()
+
+    def get_type(self):
+        '''
+        @override
+        '''
+        return self._volume.dtype
+
+    def load_subvolume(self, x0, x1, y0, y1, z0, z1, w):
+        '''
+        @override
+        '''
+        s = 2 ** w
+        shape = (z1 - z0, (y1 - y0) // s, (x1 - x0) // s)
+        [size_z, size_y, size_x] = self._volume.shape
+        # Parts of the cutout inside the volume
+        first = min(max(z0, 0), size_z)
+        last = max(first, min(z1, size_z))
+        # Skip whole steps of the cutout outside the volume
+        [j, i] = [-(-max(-y0, 0) // s), -(-max(-x0, 0) // s)]
+        [top, left] = [y0 + j * s, x0 + i * s]
+        cutout = self._volume[first:last, top:min(y1, size_y):s,
+                              left:min(x1, size_x):s]
+        cutout = cutout[:, :max(shape[1] - j, 0), :max(shape[2] - i, 0)]
+
+        if cutout.shape == shape:
+            # Views of the mapped pages without any copy
+            return np.moveaxis(cutout, 0, -1)
+        result = np.zeros(shape, dtype=self._volume.dtype)
+        if cutout.size:
+            [height, width] = cutout.shape[1:]
+            result[first - z0:last - z0, j:j + height, i:i + width] = cutout
+        return np.moveaxis(result, 0, -1)
+
+    def load_cutout(self, x0, x1, y0, y1, z, w):
+        '''
+        @override
+        '''
+        return self.load_subvolume(x0, x1, y0, y1, z, z + 1, w)[:, :, 0]
+
+    def load(self, x, y, z, w):
+        '''
+        @override
+        '''
+        [bx, by] = self.blocksize[:2]
+        s = 2 ** w
+        return self.load_cutout(x * bx * s, (x + 1) * bx * s,
+                                y * by * s, (y + 1) * by * s, z, w)
+
+    def get_boundaries(self):
+        '''
+        @override
+        '''
+        [size_z, size_y, size_x] = self._volume.shape
+        return (size_x, size_y, size_z)
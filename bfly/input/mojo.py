@@ -1,11 +1,21 @@
 import os
+import re
 import glob
+import base64
 import h5py
 import numpy as np
 from bfly.logic import core
 
 from bfly.input.datasource import DataSource
 
+'''Names of the folders of each mip level and slice'''
+LEVEL_FOLDER = re.compile(r'^w=(\d+)$')
+SLICE_FOLDER = re.compile(r'^z=(\d+)$')
+
+'''Names of the tile files with their row, column and extension'''
+TILE_FILE = re.compile(r'^y=(\d+),x=(\d+)(\.\w+)$')
+
+
 class Mojo(DataSource):
 
     def __init__(self, core, datapath):
@@ -22,76 +32,198 @@ class Mojo(DataSource):
         '''
         folderpaths = 'z=%08d'
 
-        # Max zoom level
+        # Find every tile once instead of probing files later
         base_path = os.path.join(self._datapath, 'tiles')
-        zoom_folders = os.path.join(base_path, 'w=*')
-        self.max_zoom = len(glob.glob(zoom_folders)) - 1
-
-        # Try first image to get extension
-        tmp_file = os.path.join(
-            base_path,
-            'w=00000000',
-            'z=00000000',
-            'y=00000000,x=00000000.*')
-        img_ext = os.path.splitext(glob.glob(tmp_file)[0])[1]
-        filename = 'y=%(y)08d,x=%(x)08d' + img_ext
+        self.scan_tiles(base_path)
+        self.max_zoom = max(w for w, z in self._tiles)
+
+        filename = 'y=%(y)08d,x=%(x)08d'
 
         # Tile and slice index ranges
-        slice_folders = glob.glob(os.path.join(base_path, 'w=00000000', 'z=*'))
-        y_tiles = os.path.join(slice_folders[0], 'y=*,x=00000000' + img_ext)
-        x_tiles = os.path.join(slice_folders[0], 'y=00000000,x=*' + img_ext)
-        num_slices = len(slice_folders)
+        full_tiles = [codes for (w, z), codes in self._tiles.items() if w == 0]
+        num_slices = max(z for w, z in self._tiles if w == 0) + 1
         z_ind = list(range(num_slices))
-        y_ind = list(range(len(glob.glob(y_tiles))))
-        x_ind = list(range(len(glob.glob(x_tiles))))
+        y_ind = list(range(max(codes.shape[0] for codes in full_tiles)))
+        x_ind = list(range(max(codes.shape[1] for codes in full_tiles)))
         indices = (x_ind, y_ind, z_ind)
 
         # Load info
         self.load_info(folderpaths, filename, indices)
 
         # Grab blocksize from first image
-        tmp_img = self.load(0, 0, 0, 0)
+        tmp_img = self.load_first()
         # print 'Indexing complete.\n'
         self.blocksize = tmp_img.shape
 
         super(Mojo, self).index()
 
+    def scan_tiles(self, base_path):
+        '''
+        List the tiles of every slice at every mip level
+        as a grid of their extensions, with zero if absent.
+        '''
+        self._extensions = []
+        self._tiles = {}
+        for w_entry in os.scandir(base_path):
+            w_match = LEVEL_FOLDER.match(w_entry.name)
+            if not w_match or not w_entry.is_dir():
+                continue
+            for z_entry in os.scandir(w_entry.path):
+                z_match = SLICE_FOLDER.match(z_entry.name)
+                if not z_match or not z_entry.is_dir():
+                    continue
+                found = []
+                for tile in os.scandir(z_entry.path):
+                    tile_match = TILE_FILE.match(tile.name)
+                    if not tile_match:
+                        continue
+                    [y, x, ext] = tile_match.groups()
+                    if ext not in self._extensions:
+                        self._extensions.append(ext)
+                    code = self._extensions.index(ext) + 1
+                    found.append((int(y), int(x), code))
+                if not found:
+                    continue
+                [ys, xs, codes] = np.array(found).T
+                grid = np.zeros((ys.max() + 1, xs.max() + 1), np.uint8)
+                grid[ys, xs] = codes
+                key = (int(w_match.group(1)), int(z_match.group(1)))
+                self._tiles[key] = grid
+
+    def load_first(self):
+        '''
+        Load any tile that exists at full resolution
+        '''
+        for (w, z), codes in sorted(self._tiles.items()):
+            [ys, xs] = np.nonzero(codes)
+            if w == 0 and len(ys):
+                return self.load(xs[0], ys[0], z, 0)
+
+    def get_type(self):
+        '''
+        @override
+        '''
+        return self.load_first().dtype
+
+    def empty_block(self):
+        '''
+        The zero block shared by all absent tiles
+        '''
+        if self._empty is None:
+            # The blocksize is the shape of the first tile
+            empty = np.zeros(self.blocksize[:2], dtype=self.dtype)
+            empty.flags.writeable = False
+            self._empty = empty
+        return self._empty
+
+    def index_sources(self):
+        '''
+        @override
+        '''
+        # Folders change when tiles or slices are added
+        base_path = os.path.join(self._datapath, 'tiles')
+        zoom_folders = sorted(glob.glob(os.path.join(base_path, 'w=*')))
+        slice_folders = sorted(glob.glob(os.path.join(base_path, 'w=*', 'z=*')))
+        return [base_path] + zoom_folders + slice_folders
+
+    def index_state(self):
+        '''
+        @override
+        '''
+        state = super(Mojo, self).index_state()
+        state['folderpaths'] = self._folderpaths
+        state['filename'] = self._filename
+        state['indices'] = self._indices
+        state['extensions'] = self._extensions
+        # One bitmap of the tiles with each extension
+        state['tiles'] = [
+            [w, z, list(codes.shape), [
+                base64.b64encode(np.packbits(codes == k + 1)).decode('ascii')
+                for k in range(len(self._extensions))]]
+            for (w, z), codes in sorted(self._tiles.items())]
+        return state
+
+    def restore_index(self, state):
+        '''
+        @override
+        '''
+        super(Mojo, self).restore_index(state)
+        self.load_info(state['folderpaths'], state['filename'],
+                       state['indices'])
+        self._extensions = state['extensions']
+        self._tiles = {}
+        for w, z, shape, bitmaps in state['tiles']:
+            count = shape[0] * shape[1]
+            codes = np.zeros(count, np.uint8)
+            for k, bitmap in enumerate(bitmaps):
+                bits = np.frombuffer(base64.b64decode(bitmap), np.uint8)
+                codes[np.unpackbits(bits)[:count] > 0] = k + 1
+            self._tiles[w, z] = codes.reshape(shape)
+
     def load_info(self, folderpaths, filename, indices):
         self._folderpaths = folderpaths
         self._filename = filename
         self._indices = indices
+        self._empty = None
 
-    def load(self, x, y, z, w):
+    def tile_extension(self, x, y, z, w):
+        '''
+        The extension of a stored tile, or None if absent
+        '''
+        codes = self._tiles.get((w, z))
+        if codes is None or not 0 <= y < codes.shape[0]:
+            return None
+        if not 0 <= x < codes.shape[1] or not codes[y, x]:
+            return None
+        return self._extensions[codes[y, x] - 1]
+
+    def block_path(self, x, y, z, w):
         '''
         @override
         '''
-
+        if w > self.max_zoom:
+            return None
+        if not 0 <= z < len(self._indices[2]):
+            return None
+        ext = self.tile_extension(x, y, self._indices[2][z], w)
+        if ext is None:
+            return None
         cur_filename = self._filename % {
-            'x': self._indices[0][x],
-            'y': self._indices[1][y]
-        }
-
-
-        if w <= self.max_zoom:
-            cur_path = os.path.join(
-                self._datapath,
-                'tiles',
-                'w=%08d' % w,
-                self._folderpaths %
-                self._indices[2][z],
-                cur_filename)
-            # We pass zero mip level to use the files on disk, as we don't need
-            # .load() to resize
-            return super(Mojo, self).load(cur_path, 0)
-
-        cur_path = os.path.join(
+            'x': x,
+            'y': y
+        } + ext
+        return os.path.join(
             self._datapath,
             'tiles',
-            'w=00000000',
+            'w=%08d' % w,
             self._folderpaths %
             self._indices[2][z],
             cur_filename)
-        return super(Mojo, self).load(cur_path, w)
+
+    def block_file(self, x, y, z, w):
+        '''
+        @override
+        '''
+        # The manifest lists the tiles that exist
+        return self.block_path(x, y, z, w)
+
+    def load(self, x, y, z, w):
+        '''
+        @override
+        '''
+
+        if w > self.max_zoom:
+            # Build levels missing on disk from the level below
+            return self.derive(x, y, z, w)
+
+        cur_path = self.block_path(x, y, z, w)
+        if cur_path is None:
+            # Absent tiles are empty without touching the disk
+            return self.empty_block()
+
+        # We pass zero mip level to use the files on disk, as we don't need
+        # .load() to resize
+        return super(Mojo, self).load(cur_path, 0, self.is_pinned(w))
 
     def get_boundaries(self):
         # super(Mojo, self).get_boundaries()
@@ -1,10 +1,13 @@
 from .datasource import DataSource
+import os
 import dataspec
+import threading
 import numpy as np
 from rh_renderer.models import AffineModel, Transforms
 from rh_renderer.single_tile_renderer import SingleTileRendererBase
 from rh_renderer.multiple_tiles_renderer import MultipleTilesRenderer
-from scipy.spatial import KDTree
+from bfly.logic.spatial import GridIndex
+from . import rendering
 from urllib.error import HTTPError
 from bfly.logic import core
 
@@ -22,21 +25,38 @@ class MultiBeam(DataSource):
                 [], None)
 
         super(MultiBeam, self).__init__(core, datapath)
+        self._ts_lock = threading.Lock()
 
     def index(self):
         '''
         @override
         '''
 
-        self.ts = {}
-        self.coords = {}
-        self.kdtrees = {}
+        self.load_tilespecs()
         self.min_x = np.inf
         self.max_x = - np.inf
         self.min_y = np.inf
         self.max_y = - np.inf
-        self.min_z = np.inf
-        self.max_z = - np.inf
+        for layer in self.bboxes:
+            [x0, x1, y0, y1] = self.bboxes[layer].T
+            self.min_x = min(self.min_x, x0.min())
+            self.max_x = max(self.max_x, x1.max())
+            self.min_y = min(self.min_y, y0.min())
+            self.max_y = max(self.max_y, y1.max())
+        self.min_z = min(self.bboxes)
+        self.max_z = max(self.bboxes)
+        self.build_grids()
+        ts = self.ts[self.max_z][-1]
+        self.tile_width = ts.width
+        self.tile_height = ts.height
+        self.blocksize = np.array((4096, 4096))
+
+        super(MultiBeam, self).index()
+
+    def load_tilespecs(self):
+        '''Parse all tilespecs and their bounding boxes'''
+        tilespecs = {}
+        bboxes = {}
         for tilespec in dataspec.load(self._datapath):
             for ts in tilespec:
                 bbox = ts.bbox
@@ -44,74 +64,99 @@ class MultiBeam(DataSource):
                 x1 = bbox.x1
                 y0 = bbox.y0
                 y1 = bbox.y1
-                center_x = (x0 + x1) / 2
-                center_y = (y0 + y1) / 2
                 layer = ts.layer
-                if layer not in self.coords:
-                    self.coords[layer] = []
-                    self.ts[layer] = []
-                self.coords[layer].append((center_x, center_y))
-                self.ts[layer].append(ts)
-                self.min_x = min(self.min_x, x0)
-                self.max_x = max(self.max_x, x1)
-                self.min_y = min(self.min_y, y0)
-                self.max_y = max(self.max_y, y1)
-                self.min_z = min(self.min_z, layer)
-                self.max_z = max(self.max_z, layer)
-        for layer in self.coords:
-            coords = self.coords[layer] = np.array(self.coords[layer])
-            self.kdtrees[layer] = KDTree(np.array(coords))
-        self.tile_width = ts.width
-        self.tile_height = ts.height
-        self.blocksize = np.array((4096, 4096))
+                if layer not in bboxes:
+                    bboxes[layer] = []
+                    tilespecs[layer] = []
+                bboxes[layer].append((x0, x1, y0, y1))
+                tilespecs[layer].append(ts)
+        self.bboxes = dict((k, np.array(v)) for k, v in bboxes.items())
+        self.ts = tilespecs
 
-        super(MultiBeam, self).index()
+    def tilespecs(self, z):
+        '''Get the tilespecs of a layer, parsing them if needed'''
+        if self.ts is None:
+            with self._ts_lock:
+                if self.ts is None:
+                    self.load_tilespecs()
+        return self.ts[z]
+
+    def build_grids(self):
+        '''Index the tile bounding boxes of each layer'''
+        self.grids = {}
+        for layer in self.bboxes:
+            self.grids[layer] = GridIndex(self.bboxes[layer])
+
+    def index_sources(self):
+        '''
+        @override
+        '''
+        sources = [self._datapath]
+        if os.path.isdir(self._datapath):
+            for name in sorted(os.listdir(self._datapath)):
+                sources.append(os.path.join(self._datapath, name))
+        return sources
+
+    def index_state(self):
+        '''
+        @override
+        '''
+        state = super(MultiBeam, self).index_state()
+        state['bounds'] = [float(v) for v in (
+            self.min_x, self.max_x, self.min_y, self.max_y)]
+        state['tile_shape'] = [self.tile_width, self.tile_height]
+        state['layers'] = [[layer, self.bboxes[layer].tolist()]
+                           for layer in sorted(self.bboxes)]
+        return state
+
+    def restore_index(self, state):
+        '''
+        @override
+        '''
+        super(MultiBeam, self).restore_index(state)
+        self.blocksize = np.array(self.blocksize)
+        [self.min_x, self.max_x, self.min_y, self.max_y] = state['bounds']
+        [self.tile_width, self.tile_height] = state['tile_shape']
+        self.bboxes = {}
+        for layer, bboxes in state['layers']:
+            self.bboxes[layer] = np.array(bboxes)
+        self.min_z = min(self.bboxes)
+        self.max_z = max(self.bboxes)
+        self.build_grids()
+        # Tilespecs are only parsed once a tile is rendered
+        self.ts = None
 
     def load_cutout(self, x0, x1, y0, y1, z, w):
         '''
         @override
         '''
-        if z not in self.ts or len(self.ts[z]) == 0:
+        if z not in self.bboxes or len(self.bboxes[z]) == 0:
             return np.zeros((int((x1 - x0) / 2**w),
                              int((y1 - y0) / 2**w)), np.uint8)
-        if hasattr(self.ts[z][0], "section"):
-            section = self.ts[z][0].section
+        first_ts = self.tilespecs(z)[0]
+        if hasattr(first_ts, "section"):
+            section = first_ts.section
             return section.imread(x0, y0, x1, y1, w)
-        return self.load_tilespec_cutout(x0, x1, y0, y1, z, w)
+        bounds = tuple(int(v) for v in (x0, x1, y0, y1))
+        cache_index = (self._datapath, int(z), int(w)) + bounds
+        return self.load_cached(
+            cache_index,
+            lambda: self.load_tilespec_cutout(x0, x1, y0, y1, z, w),
+            self.is_pinned(w))
 
     def load_tilespec_cutout(self, x0, x1, y0, y1, z, w):
         '''Load a cutout from tilespecs'''
-        kdtree = self.kdtrees[z]
-        assert isinstance(kdtree, KDTree)
-        x0a = x0 - self.tile_width / 2
-        x1a = x1 + self.tile_width / 2
-        y0a = y0 - self.tile_height / 2
-        y1a = y1 + self.tile_height / 2
-        nx = 2 * (x1a - x0a) / self.tile_width + 1
-        ny = 2 * (y1a - y0a) / self.tile_height + 1
-        xr = np.vstack([np.linspace(x0a, x1a, nx)] * ny)
-        yr = np.column_stack([np.linspace(y0a, y1a, ny)] * nx)
-        coords = np.column_stack([xr.flatten(), yr.flatten()])
-        d, idxs = kdtree.query(coords)
-        idxs = np.unique(idxs)
-        single_renderers = []
-        for idx in idxs:
-            ts = self.ts[z][idx]
-            transformation_models = []
-            for ts_transform in ts.get_transforms():
-                model = Transforms.from_tilespec(ts_transform)
-                transformation_models.append(model)
-            renderer = TilespecSingleTileRenderer(
-                ts, transformation_models=transformation_models,
-                compute_distances=False)
-            single_renderers.append(renderer)
-            if w > 0:
-                model = AffineModel(m=np.eye(3) / 2.0 ** w)
-                renderer.add_transformation(model)
-        renderer = MultipleTilesRenderer(
-            single_renderers, blend_type='AVERAGING', dtype=self.dtype)
-        return renderer.crop(
-            int(x0 / 2**w), int(y0 / 2**w), int(x1 / 2**w), int(y1 / 2**w))[0]
+        # The tiles whose bounding boxes overlap the cutout
+        idxs = self.grids[z].query(x0, x1, y0, y1)
+        bounds = (int(x0 / 2**w), int(y0 / 2**w),
+                  int(x1 / 2**w), int(y1 / 2**w))
+        if len(idxs) == 0:
+            # Empty areas have the shape of rendered ones
+            return rendering.average([], *bounds, dtype=self.dtype)
+        single_renderers = self.warped_tiles(z, idxs, w, 0)
+        crops = rendering.crop_tiles(
+            self._core.render_pool, single_renderers, *bounds)
+        return rendering.average(crops, *bounds, dtype=self.dtype)
 
 
     def load(self, x, y, z, w):
@@ -123,45 +168,93 @@ class MultiBeam(DataSource):
         elif z > self.max_z:
             z = self.max_z
 
-        if z not in self.kdtrees:
+        if z not in self.grids:
             return np.zeros(self.blocksize)
 
+        cache_index = (self._datapath, z, w, x, y)
+        return self.load_cached(
+            cache_index, lambda: self.render_block(x, y, z, w),
+            self.is_pinned(w))
+
+    def render_block(self, x, y, z, w):
+        '''Render one block of a layer from its tilespecs'''
         x0 = x * self.blocksize[0]
         y0 = y * self.blocksize[0]
         x1 = x0 + self.blocksize[0]
         y1 = y0 + self.blocksize[1]
 
-        kdtree = self.kdtrees[z]
-        assert isinstance(kdtree, KDTree)
-        #
-        # Look every "blocksize" within the kdtree for the closest center
-        #
-        nx = 2 * (x1 - x0) / self.tile_width + 1
-        ny = 2 * (y1 - y0) / self.tile_height + 1
-        xr = np.vstack([np.linspace(x0, x1, nx)] * ny)
-        yr = np.column_stack([np.linspace(y0, y1, ny)] * nx)
-        coords = np.column_stack([xr.flatten(), yr.flatten()])
-        d, idxs = kdtree.query(coords)
-        idxs = np.unique(idxs)
-        single_renderers = []
-        for idx in idxs:
-            ts = self.ts[z][idx]
+        # The tiles whose bounding boxes overlap the block
+        idxs = self.grids[z].query(x0, x1, y0, y1)
+        if len(idxs) == 0:
+            return np.zeros(self.blocksize)
+        single_renderers = self.warped_tiles(z, idxs, w, w)
+        renderer = MultipleTilesRenderer(single_renderers)
+        return renderer.crop(
+            x0 / 2**w, y0 / 2**w, x1 / 2**w, y1 / 2**w)[0]
+
+    def tile_models(self, z, idx):
+        '''Get the transformation models of a tile from the cache'''
+        def load_models():
+            ts = self.tilespecs(z)[idx]
+            return [Transforms.from_tilespec(ts_transform)
+                    for ts_transform in ts.get_transforms()]
+
+        cache_index = (self._datapath, 'models', z, int(idx))
+        return self.load_cached(cache_index, load_models, persist=False)
+
+    def tile_image(self, z, idx, mipmap_level):
+        '''Get the source image of a tile from the cache'''
+        def load_image():
+            ts = self.tilespecs(z)[idx]
+            return ts.imread(mipmap_level=mipmap_level)
+
+        cache_index = (self._datapath, 'image', z, int(idx), mipmap_level)
+        return self.load_cached(cache_index, load_image, persist=False)
+
+    def warped_tile(self, z, idx, w, mipmap_level):
+        '''Get a tile warped into its layer at mip level w from the cache
+
+        :param z: the layer of the tile
+        :param idx: the index of the tile in the layer
+        :param w: the mip level of the warped tile
+        :param mipmap_level: the mip level of the source image
+        :returns: a rendered :class:`TilespecSingleTileRenderer`
+        '''
+        def warp():
+            ts = self.tilespecs(z)[idx]
             renderer = TilespecSingleTileRenderer(
                 ts, compute_distances=False,
-                mipmap_level=w)
-            single_renderers.append(renderer)
-            if w > 0:
-                model = AffineModel(m=np.eye(3) * 2.0 ** w)
+                mipmap_level=mipmap_level,
+                image_loader=lambda: self.tile_image(z, idx, mipmap_level))
+            if mipmap_level > 0:
+                model = AffineModel(m=np.eye(3) * 2.0 ** mipmap_level)
                 renderer.add_transformation(model)
-            for ts_transform in ts.get_transforms():
-                model = Transforms.from_tilespec(ts_transform)
+            for model in self.tile_models(z, idx):
                 renderer.add_transformation(model)
             if w > 0:
                 model = AffineModel(m=np.eye(3) / 2.0 ** w)
                 renderer.add_transformation(model)
-        renderer = MultipleTilesRenderer(single_renderers)
-        return renderer.crop(
-            x0 / 2**w, y0 / 2**w, x1 / 2**w, y1 / 2**w)[0]
+            # Warp the whole tile now so the cache knows its size
+            renderer.render()
+            return renderer
+
+        cache_index = (self._datapath, 'warped', z, int(idx), w, mipmap_level)
+        return self.load_cached(cache_index, warp, self.is_pinned(w),
+                                persist=False)
+
+    def warped_tiles(self, z, idxs, w, mipmap_level):
+        '''Warp the tiles of a layer at the same time
+
+        :param z: the layer of the tiles
+        :param idxs: the indexes of the tiles in the layer
+        :param w: the mip level of the warped tiles
+        :param mipmap_level: the mip level of the source images
+        :returns: a list of rendered :class:`TilespecSingleTileRenderer`
+        '''
+        if len(idxs) == 1:
+            return [self.warped_tile(z, idxs[0], w, mipmap_level)]
+        return list(self._core.render_pool.map(
+            lambda idx: self.warped_tile(z, idx, w, mipmap_level), idxs))
 
     def get_boundaries(self):
 
@@ -174,16 +267,25 @@ class TilespecSingleTileRenderer(SingleTileRendererBase):
     def __init__(self, ts,
                  compute_mask=False,
                  compute_distances=True,
-                 transformation_models=[],
-                 mipmap_level=0):
+                 transformation_models=None,
+                 mipmap_level=0,
+                 image_loader=None):
         width = ts.width / 2 ** mipmap_level
         height = ts.height / 2 ** mipmap_level
         super(TilespecSingleTileRenderer, self).__init__(
             width, height, compute_mask=compute_mask, 
-            transformation_models=transformation_models,
+            transformation_models=list(transformation_models or []),
             compute_distances=compute_distances)
         self.ts = ts
         self.mipmap_level = mipmap_level
+        self.image_loader = image_loader
+
+    @property
+    def nbytes(self):
+        '''The bytes of the warped tile, rendering it if needed'''
+        return self.render()[0].nbytes
 
     def load(self):
+        if self.image_loader is not None:
+            return self.image_loader()
         return self.ts.imread(mipmap_level=self.mipmap_level)
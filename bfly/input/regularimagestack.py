@@ -4,6 +4,9 @@ import os
 import re
 import glob
 
+'''Folder of stored mip levels written by bfly_pyramid'''
+PYRAMID_FOLDER = 'pyramid'
+
 
 def convert_arg_line_to_args(arg_line):
     for arg in re.split(''' (?=(?:[^'"]|'[^']*'|"[^"]*")*$)''', arg_line):
@@ -64,8 +67,40 @@ class RegularImageStack(DataSource):
         # Grab blocksize from first image
         self.blocksize = self.get_blocksize()
 
+        # Count the complete mip levels above full resolution
+        self.max_zoom = 0
+        while os.path.isdir(os.path.dirname(os.path.dirname(
+                self.pyramid_path(0, 0, 0, self.max_zoom + 1)))):
+            self.max_zoom += 1
+
         super(RegularImageStack, self).index()
 
+    def index_sources(self):
+        '''
+        @override
+        '''
+        args_files = glob.glob(os.path.join(self._datapath, '*.args'))
+        pyramid = os.path.join(self._datapath, PYRAMID_FOLDER)
+        return args_files + [pyramid]
+
+    def index_state(self):
+        '''
+        @override
+        '''
+        state = super(RegularImageStack, self).index_state()
+        state['folderpaths'] = self._folderpaths
+        state['filename'] = self._filename
+        state['indices'] = self._indices
+        return state
+
+    def restore_index(self, state):
+        '''
+        @override
+        '''
+        super(RegularImageStack, self).restore_index(state)
+        self.load_info(state['folderpaths'], state['filename'],
+                       state['indices'])
+
     def load_info(self, folderpaths, filename, indices):
         self._folderpaths = folderpaths
         self._filename = filename
@@ -75,23 +110,49 @@ class RegularImageStack(DataSource):
         tmp_img = self.load(self._indices[0][0], self._indices[1][0], 0, 0)
         return tmp_img.shape
 
-    def load(self, x, y, z, w):
+    def pyramid_path(self, x, y, z, w):
         '''
-        @override
+        Path to a tile of a stored mip level
         '''
+        img_ext = os.path.splitext(self._filename)[1]
+        return os.path.join(
+            self._datapath,
+            PYRAMID_FOLDER,
+            'w=%08d' % w,
+            'z=%08d' % z,
+            'y=%08d,x=%08d' % (y, x) + img_ext)
 
+    def block_path(self, x, y, z, w):
+        '''
+        @override
+        '''
+        if 0 < w <= self.max_zoom:
+            return self.pyramid_path(x, y, z, w)
+        if w > 0:
+            return None
         cur_filename = self._filename % {
             'x': self._indices[0][x],
             'y': self._indices[1][y],
             'z': self._indices[2][z]}
-        print('\n')
-        print(cur_filename)
-        cur_path = os.path.join(
+        return os.path.join(
             self._datapath,
             self._folderpaths % {
                 'z': self._indices[2][z]},
             cur_filename)
-        return super(RegularImageStack, self).load(cur_path, w)
+
+    def load(self, x, y, z, w):
+        '''
+        @override
+        '''
+
+        cur_path = self.block_path(x, y, z, w)
+        if cur_path is not None:
+            # Use the file on disk without resizing
+            return super(RegularImageStack, self).load(
+                cur_path, 0, self.is_pinned(w))
+
+        # Build levels missing on disk from the level below
+        return self.derive(x, y, z, w)
 
     def get_boundaries(self):
         # super(RegularImageStack, self).get_boundaries()
@@ -0,0 +1,51 @@
+'''Warps and blends the tiles of montaged layers
+
+Warping a tile is the slow part of rendering a montage, and OpenCV
+releases the GIL while it warps, so the tiles of one cutout are warped
+and cropped at the same time. The crops are then averaged by summing
+them and dividing by the number of tiles covering each pixel.
+'''
+
+import numpy as np
+
+
+def crop_tiles(pool, renderers, from_x, from_y, to_x, to_y):
+    '''Warp and crop single tile renderers at the same time
+
+    :param pool: the executor to warp the tiles
+    :param renderers: single tile renderers of rh_renderer
+    :param from_x, from_y, to_x, to_y: the inclusive bounds of the crop
+    :returns: a list of (image, start point) for each overlapping tile
+    '''
+    def crop(renderer):
+        return renderer.crop(from_x, from_y, to_x, to_y)[:2]
+
+    if len(renderers) == 1:
+        crops = [crop(renderers[0])]
+    else:
+        crops = list(pool.map(crop, renderers))
+    return [(img, start) for img, start in crops if img is not None]
+
+
+def average(crops, from_x, from_y, to_x, to_y, dtype):
+    '''Average the crops of tiles where they overlap
+
+    :param crops: a list of (image, start point) for each tile
+    :param from_x, from_y, to_x, to_y: the inclusive bounds of the crop
+    :param dtype: the numpy dtype of the blended image
+    :returns: the blended image of the whole crop
+    '''
+    shape = (int(round(to_y + 1 - from_y)), int(round(to_x + 1 - from_x)))
+    total = np.zeros(shape, dtype=np.float32)
+    count = np.zeros(shape, dtype=np.uint16)
+    for img, start in crops:
+        [left, top] = [int(round(start[0] - from_x)),
+                       int(round(start[1] - from_y))]
+        [height, width] = [min(img.shape[0], shape[0] - top),
+                           min(img.shape[1], shape[1] - left)]
+        if height <= 0 or width <= 0:
+            continue
+        total[top:top + height, left:left + width] += img[:height, :width]
+        count[top:top + height, left:left + width] += 1
+    np.divide(total, count, out=total, where=count > 0)
+    return total.astype(dtype)
@@ -0,0 +1,207 @@
+'''A data source for tiled pyramidal TIFF and BigTIFF sections'''
+
+import os
+import numpy as np
+import tifffile
+from bfly.logic import settings
+from bfly.logic.handles import HandlePool
+
+from .datasource import DataSource
+
+'''The extensions of the TIFF files in a folder of sections'''
+TIFF_EXTENSIONS = ('.tif', '.tiff', '.btf')
+
+
+class TiffLevels(object):
+    '''An open TIFF file with the page of each mip level
+
+    The IFDs are parsed once when the file is opened. Tiles are then read
+    by their offsets in the file, so threads can read them at once.
+
+    :param filename: the path to the TIFF file
+    '''
+
+    def __init__(self, filename):
+        self._tif = tifffile.TiffFile(filename)
+        self._fd = os.open(filename, os.O_RDONLY)
+        pages = list(self._tif.pages)
+        # Sub-resolution pages may also be stored as series levels
+        for series in self._tif.series:
+            for level in getattr(series, 'levels', [])[1:]:
+                pages.extend(level.pages)
+        full = pages[0]
+        # The page of each scale by the factor it is smaller
+        self.levels = {}
+        for page in pages:
+            if page is None or page.samplesperpixel != 1:
+                continue
+            factor = float(full.imagewidth) / page.imagewidth
+            factor = int(2 ** round(np.log2(factor)))
+            lengths = (full.imagelength // factor,
+                       -(-full.imagelength // factor))
+            if page.imagelength not in lengths:
+                continue
+            self.levels.setdefault(factor, page)
+        self.full = full
+
+    def tile_shape(self, page):
+        '''Get the (y, x) shape of the tiles or strips of a page'''
+        if page.is_tiled:
+            return (page.tilelength, page.tilewidth)
+        return (min(page.rowsperstrip, page.imagelength), page.imagewidth)
+
+    def has_tile(self, page, index):
+        '''Whether a tile or strip holds any data'''
+        return page.databytecounts[index] > 0
+
+    def read_tile(self, page, index):
+        '''Read and decode one tile or strip of a page
+
+        :param page: one of the :data:`levels`
+        :param index: the index of the tile in the page
+        :returns: the (y, x) pixels of the tile
+        '''
+        count = page.databytecounts[index]
+        data = os.pread(self._fd, count, page.dataoffsets[index])
+        jpegtables = getattr(page, 'jpegtables', None)
+        tile = page.decode(data, index, jpegtables=jpegtables)[0]
+        # Remove the planes, depth and samples of the segment
+        return tile.reshape(tile.shape[-3:-1])
+
+    def close(self):
+        '''Close the file'''
+        self._tif.close()
+        os.close(self._fd)
+
+
+'''The open TIFF files shared by all datasources'''
+FILES = HandlePool(TiffLevels, settings.TIFF_HANDLES)
+
+
+class TiledTiffDataSource(DataSource):
+    '''A tiled TIFF data source
+
+    The datapath is either one tiled TIFF or BigTIFF file with a single
+    section, or a folder of such files with one section per file in the
+    order of their names. Smaller pages of each file, such as SubIFDs or
+    pages of pyramid series, serve the zoomed out mip levels.
+
+    Only the tiles that hold requested pixels are read and decoded.
+    '''
+
+    # Parsing the first file is as fast as reading an index
+    persist_index = False
+
+    def __init__(self, core, datapath):
+        self._filenames = self.find_files(datapath)
+        with FILES.open(self._filenames[0]) as tiff:
+            if not tiff.full.is_tiled:
+                raise IndexError("TIFF path %s must be tiled" % datapath)
+            # Only single channel pages can be served
+            if 1 not in tiff.levels:
+                raise IndexError("TIFF path %s must be grayscale" % datapath)
+        super(TiledTiffDataSource, self).__init__(core, datapath)
+
+    def find_files(self, path):
+        '''Find the TIFF file of every section
+
+        :param path: a TIFF file or a folder of TIFF files
+        :returns: the list of TIFF filenames
+        '''
+        if os.path.isdir(path):
+            filenames = [os.path.join(path, f)
+                         for f in sorted(os.listdir(path))
+                         if f.lower().endswith(TIFF_EXTENSIONS)]
+        elif path.lower().endswith(TIFF_EXTENSIONS):
+            filenames = [path]
+        else:
+            filenames = []
+        if not filenames:
+            raise IndexError("TIFF path %s has no TIFF files" % path)
+        return filenames
+
+    def index(self):
+        '''
+        @override
+        '''
+        with FILES.open(self._filenames[0]) as tiff:
+            full = tiff.full
+            [tile_y, tile_x] = tiff.tile_shape(full)
+            self._size = (full.imagewidth, full.imagelength)
+            self._dtype = np.dtype(full.dtype)
+            self.max_zoom = int(np.log2(max(tiff.levels)))
+        self.blocksize = (tile_x, tile_y)
+        super(TiledTiffDataSource, self).index()
+
+    def get_type(self):
+        '''
+        @override
+        '''
+        return self._dtype
+
+    def load_cutout(self, x0, x1, y0, y1, z, w):
+        '''
+        @override
+        '''
+        s = 2 ** w
+        shape = ((y1 - y0) // s, (x1 - x0) // s)
+        result = np.zeros(shape, dtype=self.dtype)
+        if not 0 <= z < len(self._filenames):
+            return result
+        filename = self._filenames[z]
+
+        with FILES.open(filename) as tiff:
+            # Read the nearest page and subsample the rest
+            factor = max(f for f in tiff.levels if f <= s)
+            page = tiff.levels[factor]
+            [tile_y, tile_x] = tiff.tile_shape(page)
+            across = -(-page.imagewidth // tile_x)
+            # Coordinates in the page of every output pixel
+            rows = (y0 + s * np.arange(shape[0])) // factor
+            cols = (x0 + s * np.arange(shape[1])) // factor
+            rows_in = rows[(rows >= 0) & (rows < page.imagelength)]
+            cols_in = cols[(cols >= 0) & (cols < page.imagewidth)]
+            tiles = [(int(ty), int(tx))
+                     for ty in np.unique(rows_in // tile_y)
+                     for tx in np.unique(cols_in // tile_x)
+                     if tiff.has_tile(page, ty * across + tx)]
+
+            def copy_tile(where):
+                [ty, tx] = where
+                index = ty * across + tx
+                cache_index = (filename, 'tile', factor, index)
+                # The tiles are compressed on disk already
+                tile = self.load_cached(
+                    cache_index, lambda: tiff.read_tile(page, index),
+                    self.is_pinned(w), persist=False)
+                # Output pixels inside this tile and their tile pixels
+                [top, left] = [ty * tile_y, tx * tile_x]
+                oy = np.flatnonzero((rows >= top) &
+                                    (rows < top + tile.shape[0]))
+                ox = np.flatnonzero((cols >= left) &
+                                    (cols < left + tile.shape[1]))
+                result[np.ix_(oy, ox)] = \
+                    tile[np.ix_(rows[oy] - top, cols[ox] - left)]
+
+            if len(tiles) == 1:
+                copy_tile(tiles[0])
+            else:
+                # Read and decode the tiles at the same time
+                list(self._core.block_pool.map(copy_tile, tiles))
+        return result
+
+    def load(self, x, y, z, w):
+        '''
+        @override
+        '''
+        [bx, by] = self.blocksize[:2]
+        s = 2 ** w
+        return self.load_cutout(x * bx * s, (x + 1) * bx * s,
+                                y * by * s, (y + 1) * by * s, z, w)
+
+    def get_boundaries(self):
+        '''
+        @override
+        '''
+        [size_x, size_y] = self._size
+        return (size_x, size_y, len(self._filenames))
@@ -1,8 +1,8 @@
 from rh_renderer.tilespec_renderer import TilespecRenderer
 from rh_renderer.models import AffineModel, Transforms
 from .datasource import DataSource
+from . import rendering
 from urllib.error import HTTPError
-from copy import deepcopy
 import numpy as np
 import dataspec
 import logging
@@ -10,6 +10,12 @@ import json
 import glob
 import os
 from bfly.logic import core
+from bfly.logic import settings
+from bfly.logic.cache import TileCache
+from bfly.logic.spatial import GridIndex
+
+'''The renderers of recently viewed layers, bounded by their bytes'''
+LAYERS = TileCache(settings.LAYER_CACHE_SIZE, 1, 'lru')
 
 class Tilespecs(DataSource):
 
@@ -31,27 +37,20 @@ class Tilespecs(DataSource):
         @override
         '''
 
-        self.layer_ts = {}
-        self.layer_renderer = {}
+        # Only the file and bounds of each layer are kept
+        self.layer_files = {}
         self.min_x = np.inf
         self.max_x = - np.inf
         self.min_y = np.inf
         self.max_y = - np.inf
-        self.min_z = np.inf
-        self.max_z = - np.inf
-        ts_fnames = glob.glob(os.path.join(self._datapath, '*.json'))
-        for ts_fname in ts_fnames:
+        for ts_fname in self.tilespec_files():
             # Load the tilespecs from the file
             tilespecs = None
             with open(ts_fname, 'r') as data:
                 tilespecs = json.load(data)
 
-
-
             layer = tilespecs[0]["layer"]
-            self.min_z = min(self.min_z, layer)
-            self.max_z = max(self.max_z, layer)
-            self.layer_ts[layer] = tilespecs
+            self.layer_files[layer] = ts_fname
             for ts in tilespecs:
                 x_min, x_max, y_min, y_max = ts["bbox"]
                 self.min_x = min(self.min_x, x_min)
@@ -59,8 +58,8 @@ class Tilespecs(DataSource):
                 self.min_y = min(self.min_y, y_min)
                 self.max_y = max(self.max_y, y_max)
 
-            self.layer_renderer[layer] = TilespecRenderer(tilespecs, self.dtype)
-
+        self.min_z = min(self.layer_files)
+        self.max_z = max(self.layer_files)
         self.tile_width = ts["width"]
         self.tile_height = ts["height"]
         self.blocksize = np.array((4096, 4096))
@@ -68,32 +67,130 @@ class Tilespecs(DataSource):
 
         super(Tilespecs, self).index()
 
+    def tilespec_files(self):
+        '''The tilespec file of every layer'''
+        return sorted(glob.glob(os.path.join(self._datapath, '*.json')))
+
+    def index_sources(self):
+        '''
+        @override
+        '''
+        return [self._datapath] + self.tilespec_files()
+
+    def index_state(self):
+        '''
+        @override
+        '''
+        state = super(Tilespecs, self).index_state()
+        state['bounds'] = [float(v) for v in (
+            self.min_x, self.max_x, self.min_y, self.max_y)]
+        state['tile_shape'] = [self.tile_width, self.tile_height]
+        state['layers'] = [[layer, self.layer_files[layer]]
+                           for layer in sorted(self.layer_files)]
+        return state
+
+    def restore_index(self, state):
+        '''
+        @override
+        '''
+        super(Tilespecs, self).restore_index(state)
+        self.blocksize = np.array(self.blocksize)
+        [self.min_x, self.max_x, self.min_y, self.max_y] = state['bounds']
+        [self.tile_width, self.tile_height] = state['tile_shape']
+        self.layer_files = dict(state['layers'])
+        self.min_z = min(self.layer_files)
+        self.max_z = max(self.layer_files)
+
+    def layer_tilespecs(self, z):
+        '''Parse the tilespecs of one layer'''
+        with open(self.layer_files[z], 'r') as data:
+            return json.load(data)
+
     def get_type(self):
         '''
         @override
         '''
-        return self.load(0,0,0,0).single_tiles[0].render()[0].dtype
+        tilespecs = self.layer_tilespecs(self.min_z)
+        renderer = TilespecRenderer(tilespecs[:1])
+        return renderer.single_tiles[0].render()[0].dtype
 
     def load_cutout(self, x0, x1, y0, y1, z, w):
         '''
         @override
         '''
+        bounds = tuple(int(v) for v in (x0, x1, y0, y1))
+        cache_index = (self._datapath, int(z), int(w)) + bounds
+        return self.load_cached(
+            cache_index,
+            lambda: self.render_cutout(x0, x1, y0, y1, z, w),
+            self.is_pinned(w))
+
+    def render_cutout(self, x0, x1, y0, y1, z, w):
+        '''Render a cutout of a layer from its tilespecs'''
         cutout_bounds = np.array([x0, y0, x1, y1])/(2.0 ** w)
         cutout_bounds = cutout_bounds.astype(np.uint32)-(0,0,1,1)
-        img = self.load(0,0,z,w).single_tiles[0].crop(*cutout_bounds)[0]
-        return img
+        [from_x, from_y, to_x, to_y] = cutout_bounds
+        # Warp the tiles at the same time and average their overlaps
+        renderer = self.load(0,0,z,w)
+        crops = rendering.crop_tiles(
+            self._core.render_pool,
+            renderer.overlapping(from_x, from_y, to_x, to_y),
+            from_x, from_y, to_x, to_y)
+        return rendering.average(crops, from_x, from_y, to_x, to_y,
+                                 self.dtype)
 
     def load(self, x, y, z, w):
         '''
         @override
         '''
-        plane_rendered = deepcopy(self.layer_renderer[z])
-        if w > 0:
-            model = AffineModel(m=np.eye(3) / 2.0 ** w)
-            plane_rendered.add_transformation(model)
-
-        return plane_rendered
+        cache_index = (self._datapath, 'renderer', z, w)
+        renderer = LAYERS.get(cache_index)
+        if renderer is None:
+            # Concurrent requests for one layer share a single parse
+            renderer = self._core._flights.do(
+                cache_index, lambda: self.build_renderer(z, w))
+        return renderer
+
+    def build_renderer(self, z, w):
+        '''Parse a layer and keep its renderer until it is evicted'''
+        renderer = LayerRenderer(self.layer_tilespecs(z), self.dtype, w)
+        LAYERS.set((self._datapath, 'renderer', z, w), renderer)
+        return renderer
 
     def get_boundaries(self):
 
         return self.max_x - self.min_x, self.max_y - self.min_y, self.max_z
+
+
+class LayerRenderer(TilespecRenderer):
+    '''A TilespecRenderer of a layer scaled to a mip level
+
+    :param tilespecs: the tilespecs of every tile in the layer
+    :param dtype: the numpy dtype of the rendered tiles
+    :param w: the mip level of the rendered layer
+    '''
+
+    def __init__(self, tilespecs, dtype, w):
+        super(LayerRenderer, self).__init__(tilespecs, dtype)
+        if w > 0:
+            model = AffineModel(m=np.eye(3) / 2.0 ** w)
+            self.add_transformation(model)
+        # The bytes of all the warped tiles once they are rendered
+        pixels = sum(ts["width"] * ts["height"] for ts in tilespecs)
+        self._nbytes = pixels * np.dtype(dtype).itemsize // 4 ** w
+        # The tile bounding boxes at this mip level
+        bboxes = np.array([ts["bbox"] for ts in tilespecs], dtype=float)
+        self.grid = GridIndex(bboxes / 2.0 ** w)
+
+    def overlapping(self, from_x, from_y, to_x, to_y):
+        '''Get the single tile renderers overlapping a crop
+
+        :param from_x, from_y, to_x, to_y: the inclusive bounds of the crop
+        :returns: a list of single tile renderers
+        '''
+        idxs = self.grid.query(from_x, to_x + 1, from_y, to_y + 1)
+        return [self.single_tiles[i] for i in idxs]
+
+    @property
+    def nbytes(self):
+        return self._nbytes
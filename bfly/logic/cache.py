@@ -0,0 +1,380 @@
+""" A thread-safe tile cache shared by all datasources
+
+The cache is split into shards, each guarded by its own lock, so that
+worker threads loading different tiles rarely wait on each other. Every
+entry is counted by its size in bytes and each shard evicts entries in
+constant time, either by least recent use or by the scan-resistant 2Q
+policy. Tiles can also be pinned to keep them safe from eviction.
+Values too big for one shard are kept in one more shard of their own.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+
+
+def sizeof(value):
+    '''Get the number of bytes held by a cached value
+
+    :param value: a numpy array, a string of bytes or any object
+    :returns: the size of the value in bytes
+    '''
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is not None:
+        return int(nbytes)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class _CacheShard(object):
+    '''One lock-protected least recently used partition of the cache
+
+    Pinned entries live apart from the others and are only evicted by
+    other pinned entries, once they fill ``pin_size`` bytes.
+    '''
+
+    def __init__(self, max_size, pin_size):
+        self.max_size = max_size
+        self.pin_size = pin_size
+        self.size = 0
+        self.pinned_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self._pinned = OrderedDict()
+        self._entries = OrderedDict()
+
+    def get(self, key, default):
+        with self.lock:
+            entry = self._pinned.get(key)
+            if entry is not None:
+                self._pinned.move_to_end(key)
+            else:
+                entry = self._get_entry(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, nbytes, pinned):
+        # Values too big for the pinned area are cached unpinned
+        if pinned and nbytes > self.pin_size:
+            pinned = False
+        # Never let one value flush the whole shard
+        if nbytes > self.max_size:
+            with self.lock:
+                self.dropped += 1
+            return
+        with self.lock:
+            self._discard(key)
+            if pinned:
+                self._pinned[key] = (value, nbytes)
+                self.pinned_size += nbytes
+                self.size += nbytes
+                while self.pinned_size > self.pin_size:
+                    _, (_, old_bytes) = self._pinned.popitem(last=False)
+                    self.pinned_size -= old_bytes
+                    self.size -= old_bytes
+                    self.evictions += 1
+            else:
+                self._set_entry(key, value, nbytes)
+                self.size += nbytes
+            # Remove unpinned items until everything fits
+            while self.size > self.max_size and self._evict():
+                self.evictions += 1
+
+    def trim(self, max_size):
+        '''Remove unpinned entries until the shard fits in max_size'''
+        with self.lock:
+            while self.size > max_size and self._evict():
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def clear(self):
+        with self.lock:
+            self._pinned.clear()
+            self._entries.clear()
+            self.size = 0
+            self.pinned_size = 0
+
+    def _discard(self, key):
+        old = self._pinned.pop(key, None)
+        if old is not None:
+            self.pinned_size -= old[1]
+        else:
+            old = self._pop_entry(key)
+        if old is not None:
+            self.size -= old[1]
+
+    def _get_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            # Move most recently accessed items to the end
+            self._entries.move_to_end(key)
+        return entry
+
+    def _set_entry(self, key, value, nbytes):
+        self._entries[key] = (value, nbytes)
+
+    def _pop_entry(self, key):
+        return self._entries.pop(key, None)
+
+    def _evict(self):
+        '''Remove the least recently used entry
+
+        :returns: whether any entry could be removed
+        '''
+        if not self._entries:
+            return False
+        _, (_, old_bytes) = self._entries.popitem(last=False)
+        self.size -= old_bytes
+        return True
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self._pinned or key in self._entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self._pinned) + len(self._entries)
+
+
+class _TwoQueueShard(_CacheShard):
+    '''A partition of the cache using the 2Q replacement policy
+
+    New entries first go to a FIFO queue holding a quarter of the shard.
+    Only the keys of entries evicted from that queue are remembered, so
+    a tile must be requested twice before it reaches the main queue.
+    This keeps long scans through many planes from flushing the tiles
+    that every viewer asks for again and again.
+    '''
+
+    def __init__(self, max_size, pin_size):
+        super(_TwoQueueShard, self).__init__(max_size, pin_size)
+        self._in_size = 0
+        self._in_limit = max_size // 4
+        self._ghost_size = 0
+        self._ghost_limit = max_size // 2
+        # Entries seen once, and keys recently evicted from them
+        self._in = OrderedDict()
+        self._ghosts = OrderedDict()
+
+    def clear(self):
+        with self.lock:
+            self._in.clear()
+            self._ghosts.clear()
+            self._in_size = 0
+            self._ghost_size = 0
+        super(_TwoQueueShard, self).clear()
+
+    def _get_entry(self, key):
+        entry = self._in.get(key)
+        if entry is not None:
+            # Hits in the FIFO queue do not promote the entry
+            return entry
+        return super(_TwoQueueShard, self)._get_entry(key)
+
+    def _set_entry(self, key, value, nbytes):
+        ghost_bytes = self._ghosts.pop(key, None)
+        if ghost_bytes is not None:
+            self._ghost_size -= ghost_bytes
+            self._entries[key] = (value, nbytes)
+        else:
+            self._in[key] = (value, nbytes)
+            self._in_size += nbytes
+
+    def _pop_entry(self, key):
+        old = self._in.pop(key, None)
+        if old is not None:
+            self._in_size -= old[1]
+            return old
+        return self._entries.pop(key, None)
+
+    def _evict(self):
+        if self._in and (self._in_size > self._in_limit or
+                         not self._entries):
+            key, (_, old_bytes) = self._in.popitem(last=False)
+            self._in_size -= old_bytes
+            self.size -= old_bytes
+            # Remember the key to promote it if requested again
+            self._ghosts[key] = old_bytes
+            self._ghost_size += old_bytes
+            while self._ghost_size > self._ghost_limit:
+                _, ghost_bytes = self._ghosts.popitem(last=False)
+                self._ghost_size -= ghost_bytes
+            return True
+        return super(_TwoQueueShard, self)._evict()
+
+    def __contains__(self, key):
+        with self.lock:
+            return any(key in d for d in (self._in, self._pinned,
+                                          self._entries))
+
+    def __len__(self):
+        with self.lock:
+            return len(self._in) + len(self._pinned) + len(self._entries)
+
+
+'''Replacement policies by the name used in the config'''
+POLICIES = {
+    'lru': _CacheShard,
+    '2q': _TwoQueueShard,
+}
+
+
+class TileCache(object):
+    '''A sharded, byte-accounted tile cache
+
+    :param max_size: the total number of bytes to keep in the cache
+    :param shards: the number of independently locked partitions
+    :param policy: the name of a replacement policy in :data:`POLICIES`
+    :param pin_fraction: the part of the cache that pinned tiles may use
+
+    Values bigger than one shard go to an overflow shard that may use the
+    whole budget, and that gives back what the other shards are using.
+    '''
+
+    def __init__(self, max_size, shards=16, policy='lru', pin_fraction=0):
+        if policy not in POLICIES:
+            msg = 'Cache policy must be one of %s' % sorted(POLICIES)
+            raise ValueError(msg)
+        shards = max(1, int(shards))
+        shard_size = max_size // shards
+        pin_size = int(shard_size * pin_fraction)
+        self.max_size = max_size
+        self.policy = policy
+        self._shards = [POLICIES[policy](shard_size, pin_size)
+                        for _ in range(shards)]
+        self._shard_size = shard_size
+        self._large = POLICIES[policy](max_size, int(max_size * pin_fraction))
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def get(self, key, default=None):
+        '''Get a value and mark it as most recently used
+
+        :param key: any hashable key
+        :param default: returned if the key is not in the cache
+        '''
+        large = self._large
+        if large.size and key in large:
+            return large.get(key, default)
+        return self._shard(key).get(key, default)
+
+    def set(self, key, value, pinned=False):
+        '''Store a value, evicting old entries to stay in budget
+
+        :param key: any hashable key
+        :param value: the value to store, usually a numpy array
+        :param pinned: whether to keep the value apart from the \
+replacement policy, so only other pinned values can evict it
+        '''
+        nbytes = sizeof(value)
+        large = self._large
+        if nbytes <= self._shard_size:
+            self._shard(key).set(key, value, nbytes, pinned)
+            if not large.size:
+                return
+            large.pop(key)
+            nbytes = 0
+        else:
+            self._shard(key).pop(key)
+            large.set(key, value, nbytes, pinned)
+        # Keep the whole cache within its budget, apart from a new value
+        used = sum(shard.size for shard in self._shards)
+        large.trim(max(nbytes, self.max_size - used))
+
+    def pop(self, key):
+        '''Remove a key from the cache if present'''
+        self._shard(key).pop(key)
+        self._large.pop(key)
+
+    def clear(self):
+        '''Remove every entry from the cache'''
+        for shard in self._shards + [self._large]:
+            shard.clear()
+
+    @property
+    def size(self):
+        '''The number of bytes currently held in the cache'''
+        return sum(shard.size for shard in self._shards + [self._large])
+
+    def stats(self):
+        '''Get the hit, miss and eviction counters of the cache
+
+        :returns: a dictionary of counters summed over all shards
+        '''
+        keys = ('hits', 'misses', 'evictions', 'dropped', 'size',
+                'pinned_size')
+        totals = dict.fromkeys(keys, 0)
+        for shard in self._shards + [self._large]:
+            with shard.lock:
+                for k in keys:
+                    totals[k] += getattr(shard, k)
+        totals['count'] = len(self)
+        totals['max_size'] = self.max_size
+        totals['policy'] = self.policy
+        return totals
+
+    def __contains__(self, key):
+        return key in self._shard(key) or key in self._large
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards + [self._large])
+
+
+class _Call(object):
+    '''A computation that other threads may be waiting on'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''Share one computation between concurrent requests of one key
+
+    The first thread to ask for a key runs the loader, while every other
+    thread asking for that key meanwhile waits and gets the same result.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, loader):
+        '''Run the loader unless another thread is running it
+
+        :param key: any hashable key
+        :param loader: a function without arguments
+        :returns: the result of the one call to the loader
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = loader()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
@@ -1,9 +1,15 @@
 import logging
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 import urllib.request, urllib.error, urllib.parse
 
 from bfly.logic import settings
-from collections import OrderedDict
+from bfly.logic import passthrough
+from bfly.logic.cache import TileCache, SingleFlight
+from bfly.logic.diskcache import DiskCache
+from bfly.logic.sharedcache import SharedTileCache
+from bfly.logic.prefetch import Prefetcher
 
 class Core(object):
 
@@ -11,11 +17,58 @@ class Core(object):
         '''
         '''
         self._datasources = {}
+        self._datasource_lock = threading.Lock()
         self.vol_xy_start = [0, 0]
         self.tile_xy_start = [0, 0]
-        self._cache = OrderedDict()
-        self._max_cache_size = settings.MAX_CACHE_SIZE
-        self._current_cache_size = 0
+        self._cache = self.create_cache()
+        self._flights = SingleFlight()
+        # Load the blocks of each cutout at the same time
+        self._block_pool = ThreadPoolExecutor(settings.BLOCK_THREADS)
+        # Warp the tiles of each montage at the same time
+        self._render_pool = ThreadPoolExecutor(settings.RENDER_THREADS)
+        prefetch_threads = settings.PREFETCH_THREADS if settings.PREFETCH else 0
+        self._prefetcher = Prefetcher(prefetch_threads,
+                                      settings.PREFETCH_DEPTH,
+                                      settings.PREFETCH_QUEUE)
+        self._disk_cache = None
+        if settings.DISK_CACHE_PATH:
+            self._disk_cache = DiskCache(settings.DISK_CACHE_PATH,
+                                         settings.DISK_CACHE_SIZE,
+                                         settings.DISK_CACHE_LEVEL)
+
+    @property
+    def block_pool(self):
+        '''
+        The executor loading blocks, with its own for background loads.
+        '''
+        if self._prefetcher.in_background():
+            return self._prefetcher.block_pool
+        return self._block_pool
+
+    @property
+    def render_pool(self):
+        '''
+        The executor warping tiles, with its own for background loads.
+        '''
+        if self._prefetcher.in_background():
+            return self._prefetcher.render_pool
+        return self._render_pool
+
+    def create_cache(self):
+        '''
+        Create the tile cache, shared by all forked processes if needed.
+        '''
+        if settings.PROCESSES == 1:
+            return TileCache(settings.MAX_CACHE_SIZE,
+                             settings.CACHE_SHARDS,
+                             settings.CACHE_POLICY,
+                             settings.CACHE_PIN_FRACTION)
+        # Tiles that cannot be shared stay in each process
+        local = TileCache(settings.PROCESS_CACHE_SIZE,
+                          settings.CACHE_SHARDS,
+                          settings.CACHE_POLICY,
+                          settings.CACHE_PIN_FRACTION)
+        return SharedTileCache(settings.MAX_CACHE_SIZE, local)
 
     def load_view(self,datasource,view,bounds):
         plane = datasource.load_cutout(*bounds)
@@ -38,22 +91,109 @@ class Core(object):
         if 'w' in kwargs:
             w = int(kwargs['w'])
 
-        # if datapath is not indexed (knowing the meta information),
-        # do it now
-        if datapath not in self._datasources:
-            self.create_datasource(datapath)
-
-        datasource = self._datasources[datapath]
+        datasource = self.open_datasource(datapath)
 
-        planes = []
         scale = 2 ** w
         [x0,y0] = np.array(start_coord[:-1]) * scale
         [x1,y1] = np.array(vol_size[:-1])*scale + [x0,y0]
-        for z in range(start_coord[2], start_coord[2] + vol_size[2]):
-            bounds = [x0, x1, y0, y1, z, w]
-            plane = self.load_view(datasource, view, bounds)
-            planes.append(plane)
-        return np.dstack(planes)
+        z0 = start_coord[2]
+        z1 = start_coord[2] + vol_size[2]
+        with self._prefetcher.foreground():
+            volume = None
+            if view == 'grayscale':
+                # Read all the planes at once if the format can
+                volume = datasource.load_subvolume(x0, x1, y0, y1, z0, z1, w)
+            if volume is None:
+                planes = []
+                for z in range(z0, z1):
+                    bounds = [x0, x1, y0, y1, z, w]
+                    plane = self.load_view(datasource, view, bounds)
+                    planes.append(plane)
+                volume = np.dstack(planes)
+        # Load the next planes and tiles in the background
+        self._prefetcher.request(datasource, x0, x1, y0, y1, z0, z1, w)
+        return volume
+
+    def get_file(self, datapath, start_coord, vol_size, **kwargs):
+        '''
+        Read the stored file of a request for exactly one block in the
+        format of the file, or return None to load and encode the block.
+        '''
+        w = int(kwargs.get('w', 0))
+        view = kwargs.get('view', settings.DEFAULT_VIEW)
+        fmt = kwargs.get('fmt', settings.DEFAULT_OUTPUT)
+        if view != 'grayscale' or vol_size[2] != 1:
+            return None
+
+        datasource = self.open_datasource(datapath)
+        if datasource.dtype != np.uint8 or w > datasource.max_zoom:
+            return None
+        [bx, by] = [int(b) for b in datasource.blocksize[:2]]
+        [x0, y0, z] = [int(c) for c in start_coord]
+        if list(vol_size[:2]) != [bx, by]:
+            return None
+        scale = 2 ** w
+        [x0, y0] = [x0 * scale, y0 * scale]
+
+        with self._prefetcher.foreground():
+            content = self.load_file(datasource, x0, y0, z, w, fmt)
+        if content is None:
+            return None
+
+        def prefetch_file(x0, x1, y0, y1, z, w):
+            self.load_file(datasource, x0, y0, z, w, fmt)
+
+        # Read the next files in the background, as they are sent
+        self._prefetcher.request(datasource, x0, x0 + bx * scale,
+                                 y0, y0 + by * scale, z, z + 1, w,
+                                 prefetch_file)
+        return content
+
+    def load_file(self, datasource, x0, y0, z, w, fmt):
+        '''
+        Read the stored file of one block starting at full resolution
+        x0, y0 if it can be sent as it is in a format, or return None.
+        '''
+        [bx, by] = [int(b) for b in datasource.blocksize[:2]]
+        scale = 2 ** w
+        if x0 % (bx * scale) or y0 % (by * scale):
+            return None
+        # Only blocks inside the data are whole in their files
+        [size_x, size_y, size_z] = datasource.get_boundaries()
+        if min(x0, y0, z) < 0 or z >= size_z:
+            return None
+        if x0 + bx * scale > size_x or y0 + by * scale > size_y:
+            return None
+        cur_path = datasource.block_file(x0 // (bx * scale),
+                                         y0 // (by * scale), z, w)
+        if cur_path is None:
+            return None
+
+        def read_block():
+            content = passthrough.read_block(cur_path, fmt, (by, bx))
+            # An empty array marks files that must be encoded
+            return np.frombuffer(content or b'', dtype=np.uint8)
+
+        # The bytes are only kept in the tile cache, shared as an array
+        # by all processes, and not as encoded responses
+        cache_index = ('file', cur_path, passthrough.FORMATS.get(fmt))
+        content = datasource.load_cached(
+            cache_index, read_block, datasource.is_pinned(w), persist=False)
+        return content.tobytes() if content.size else None
+
+    def open_datasource(self, datapath):
+        '''
+        Get the datasource of a datapath, indexing it the first time.
+        '''
+        # if datapath is not indexed (knowing the meta information),
+        # do it now
+        if datapath not in self._datasources:
+            # Only one worker thread indexes each datapath
+            with self._datasource_lock:
+                if datapath not in self._datasources:
+                    self.create_datasource(datapath)
+
+        return self._datasources[datapath]
 
     def create_datasource(self, datapath):
         '''
@@ -69,7 +209,19 @@ class Core(object):
                 [], None)
         for datasource in settings.DATASOURCES:
             try:
-                if datasource == 'mojo':
+                if datasource == 'memmap':
+                    from bfly.input.memmap import MemmapDataSource
+                    ds = MemmapDataSource(self, datapath)
+                    break
+                elif datasource == 'chunkstore':
+                    from bfly.input.chunkstore import ChunkStoreDataSource
+                    ds = ChunkStoreDataSource(self, datapath)
+                    break
+                elif datasource == 'tiledtiff':
+                    from bfly.input.tiledtiff import TiledTiffDataSource
+                    ds = TiledTiffDataSource(self, datapath)
+                    break
+                elif datasource == 'mojo':
                     from bfly.input.mojo import Mojo
                     ds = Mojo(self, datapath)
                     break
@@ -98,8 +250,10 @@ class Core(object):
             raise urllib.error.HTTPError(
                 None, 404, "Can't find a loader for datapath=%s" % datapath,
                 [], None)
-        # call index
-        ds.index()
+        # call index unless the saved index is still valid
+        if not ds.load_index():
+            ds.index()
+            ds.save_index()
 
         self._datasources[datapath] = ds
 
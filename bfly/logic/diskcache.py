@@ -0,0 +1,209 @@
+""" A persistent second tier for the tile cache
+
+Decoded or rendered tiles are stored as zlib-compressed files under one
+directory, so they survive restarts of the server. The files are named
+by a hash of the tile key and the oldest ones are removed once they fill
+the size limit of the cache.
+
+Each tile also records the modification time and size of the file it
+was read from, so tiles of files that were written again are dropped.
+Every process sharing the directory rescans it after writing a part of
+the size limit, and evicts while holding a lock file, so the limit holds
+for all of them together.
+"""
+
+import os
+import zlib
+import fcntl
+import struct
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+
+'''File extension of the cached tiles'''
+EXTENSION = '.tile'
+
+'''Identifies the tile format, bump the version to change it'''
+MAGIC = b'BFLY\x02'
+
+'''Header of the source stamp, dtype length and number of dimensions'''
+HEADER = struct.Struct('<qqBB')
+
+'''File locked by the process evicting tiles'''
+LOCK_FILE = '.lock'
+
+'''Fraction of the size limit written between scans of the directory'''
+SCAN_FRACTION = 16
+
+
+class DiskCache(object):
+    '''A least recently used cache of tiles on the local disk
+
+    :param path: the directory holding all cached tiles
+    :param max_size: the total number of bytes to keep on disk
+    :param level: the zlib compression level from 0 to 9
+    '''
+
+    def __init__(self, path, max_size, level=1):
+        self.path = os.path.realpath(os.path.expanduser(path))
+        self.max_size = max_size
+        self.level = level
+        self.size = 0
+        self._written = 0
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+        self._scan()
+
+    def _scan(self):
+        '''Find the tiles on disk, written by any process'''
+        found = []
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if not name.endswith(EXTENSION):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                found.append((stat.st_mtime, name[:-len(EXTENSION)],
+                              stat.st_size))
+        # The oldest files are the first to be evicted
+        tiles = OrderedDict()
+        for _, name, nbytes in sorted(found):
+            tiles[name] = nbytes
+        with self._lock:
+            self._files = tiles
+            self.size = sum(tiles.values())
+            self._written = 0
+
+    def _name(self, key):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def _file(self, name):
+        return os.path.join(self.path, name[:2], name + EXTENSION)
+
+    def get(self, key, stamp=None):
+        '''Load a tile from the disk
+
+        :param key: the key used to store the tile
+        :param stamp: the (mtime, size) of the source of the tile
+        :returns: the numpy array or None if not on disk or stale
+        '''
+        name = self._name(key)
+        with self._lock:
+            if name not in self._files:
+                return None
+            self._files.move_to_end(name)
+        filename = self._file(name)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            tile_stamp, tile = self._decode(data)
+        except (IOError, OSError, ValueError, zlib.error):
+            logging.warning('Cannot read cached tile %s' % filename)
+            self._forget(name)
+            return None
+        if tile_stamp != self._stamp(stamp):
+            # The source was written again since the tile was cached
+            self._forget(name)
+            return None
+        # Keep the order of use for every process and the next restart
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return tile
+
+    def set(self, key, tile, stamp=None):
+        '''Write a tile to the disk, removing the oldest tiles
+
+        :param key: any key with a stable ``repr``
+        :param tile: the numpy array to store
+        :param stamp: the (mtime, size) of the source of the tile
+        '''
+        name = self._name(key)
+        filename = self._file(name)
+        data = self._encode(tile, stamp)
+        if len(data) > self.max_size:
+            return
+        try:
+            folder = os.path.dirname(filename)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            # Write then rename so readers never see part of a tile
+            tmp_file = '%s.%d.%d' % (filename, os.getpid(),
+                                     threading.current_thread().ident)
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_file, filename)
+        except (IOError, OSError):
+            logging.warning('Cannot write cached tile %s' % filename)
+            return
+        with self._lock:
+            self.size -= self._files.pop(name, 0)
+            self._files[name] = len(data)
+            self.size += len(data)
+            self._written += len(data)
+            # Other processes may have written since the last scan
+            full = self.size > self.max_size or \
+                self._written > self.max_size // SCAN_FRACTION
+        if full:
+            self._evict()
+
+    def _evict(self):
+        '''Remove the oldest tiles of all processes over the limit'''
+        try:
+            lock_file = open(os.path.join(self.path, LOCK_FILE), 'a')
+        except (IOError, OSError):
+            logging.warning('Cannot lock the disk cache %s' % self.path)
+            return
+        with lock_file:
+            # Only one process evicts at a time
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._scan()
+            with self._lock:
+                old_names = []
+                while self.size > self.max_size and self._files:
+                    old_name, old_bytes = self._files.popitem(last=False)
+                    self.size -= old_bytes
+                    old_names.append(old_name)
+            for old_name in old_names:
+                self._remove(old_name)
+
+    def _forget(self, name):
+        with self._lock:
+            self.size -= self._files.pop(name, 0)
+        self._remove(name)
+
+    def _remove(self, name):
+        try:
+            os.remove(self._file(name))
+        except OSError:
+            pass
+
+    def _stamp(self, stamp):
+        '''The stamp written for a source, zeros if it has none'''
+        return tuple(int(v) for v in stamp) if stamp else (0, 0)
+
+    def _encode(self, tile, stamp=None):
+        tile = np.asarray(tile)
+        dtype = tile.dtype.str.encode('ascii')
+        shape = struct.pack('<%dQ' % tile.ndim, *tile.shape)
+        body = zlib.compress(np.ascontiguousarray(tile).tobytes(), self.level)
+        head = HEADER.pack(*(self._stamp(stamp) + (len(dtype), tile.ndim)))
+        return MAGIC + head + dtype + shape + body
+
+    def _decode(self, data):
+        if not data.startswith(MAGIC):
+            raise ValueError('Not a cached tile')
+        offset = len(MAGIC)
+        mtime, size, n_dtype, ndim = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        dtype = np.dtype(data[offset:offset + n_dtype].decode('ascii'))
+        offset += n_dtype
+        shape = struct.unpack_from('<%dQ' % ndim, data, offset)
+        offset += 8 * ndim
+        body = zlib.decompress(data[offset:])
+        return (mtime, size), np.frombuffer(body, dtype=dtype).reshape(shape)
@@ -0,0 +1,68 @@
+""" Keeps files open between requests
+
+Opening a file such as HDF5 parses its metadata again on every call,
+which can cost more than reading a small tile. A pool keeps a bounded
+number of open handles by filename, shared by all threads, and closes
+the least recently used handles that no thread is reading.
+"""
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class HandlePool(object):
+    '''A bounded pool of open files shared between threads
+
+    :param opener: a function to open a file from its name
+    :param max_open: the most files to keep open while unused
+    '''
+
+    def __init__(self, opener, max_open):
+        self._opener = opener
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        # The handle and the number of users of each file
+        self._handles = OrderedDict()
+
+    @contextmanager
+    def open(self, name):
+        '''Borrow the open handle of a file
+
+        :param name: the path to the file
+        :returns: a context manager for the open handle
+        '''
+        with self._lock:
+            entry = self._handles.get(name)
+            if entry is None:
+                entry = [self._opener(name), 0]
+                self._handles[name] = entry
+            else:
+                self._handles.move_to_end(name)
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                self._close_unused(self.max_open)
+
+    def _close_unused(self, keep):
+        '''Close the oldest unused handles above the limit'''
+        extra = len(self._handles) - keep
+        for name in list(self._handles):
+            if extra <= 0:
+                break
+            [handle, users] = self._handles[name]
+            if users == 0:
+                del self._handles[name]
+                handle.close()
+                extra -= 1
+
+    def close(self):
+        '''Close every handle that no thread is using'''
+        with self._lock:
+            self._close_unused(0)
+
+    def __len__(self):
+        return len(self._handles)
@@ -0,0 +1,78 @@
+''' Sends stored tile files without decoding them
+
+Viewers mostly ask for exactly one stored block in the format of its
+file. The bytes of the file are then the response, so the block is not
+decoded and encoded again. The header of the file is checked first, as
+only 8 bit grayscale images of the whole block match a decoded block.
+'''
+
+import struct
+
+'''The file formats that can be sent, by their requested names'''
+FORMATS = {
+    'png': 'png',
+    'jpg': 'jpg',
+    'jpeg': 'jpg',
+}
+
+'''The JPEG markers that start a frame with the image size'''
+JPEG_FRAMES = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+
+def png_header(data):
+    '''Get the format, (height, width) and whether 8 bit gray of a PNG'''
+    if len(data) < 26 or not data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return None
+    [width, height, depth, color] = struct.unpack('>IIBB', data[16:26])
+    return 'png', (height, width), depth == 8 and color == 0
+
+
+def jpeg_header(data):
+    '''Get the format, (height, width) and whether 8 bit gray of a JPEG'''
+    if not data.startswith(b'\xff\xd8'):
+        return None
+    offset = 2
+    # Skip segments until the frame header
+    while offset + 4 <= len(data):
+        [mark, marker, length] = struct.unpack('>BBH',
+                                               data[offset:offset + 4])
+        if mark != 0xFF:
+            return None
+        if marker in JPEG_FRAMES:
+            frame = data[offset + 4:offset + 10]
+            if len(frame) < 6:
+                return None
+            [depth, height, width, planes] = struct.unpack('>BHHB', frame)
+            return 'jpg', (height, width), depth == 8 and planes == 1
+        offset += 2 + length
+    return None
+
+
+def image_header(data):
+    '''Describe the image in the bytes of a file
+
+    :param data: the first bytes of a PNG or JPEG file
+    :returns: the format, (height, width) and whether it is 8 bit gray
+    '''
+    return png_header(data) or jpeg_header(data)
+
+
+def read_block(path, fmt, shape):
+    '''Read a file to send as it is for one block
+
+    :param path: the stored file of the block
+    :param fmt: the requested output format
+    :param shape: the (height, width) of the requested block
+    :returns: the bytes of the file or None if it must be encoded
+    '''
+    if FORMATS.get(fmt) is None:
+        return None
+    with open(path, 'rb') as f:
+        data = f.read()
+    header = image_header(data)
+    if header is None:
+        return None
+    [file_format, file_shape, gray] = header
+    if file_format != FORMATS[fmt] or tuple(file_shape) != tuple(shape):
+        return None
+    return data if gray else None
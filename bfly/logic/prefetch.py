@@ -0,0 +1,126 @@
+""" Loads the neighbours of requested tiles in the background
+
+After each request, the same cutout in the nearest planes and the
+neighbouring cutouts in the same plane are queued for a few background
+threads. The threads only load while no foreground request is running,
+and the newest requests are loaded first, so prefetching follows the
+viewer and never slows it down. Background loads read their blocks and
+warp their tiles on small pools of their own, so a load that is already
+running never takes the threads of a foreground request.
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher(object):
+    '''A bounded queue of background cutout loads
+
+    :param threads: the number of background threads, or 0 to disable
+    :param depth: the number of planes to load above and below
+    :param max_queue: the most cutouts waiting to load at once
+    '''
+
+    def __init__(self, threads, depth, max_queue):
+        self.threads = threads
+        self.depth = depth
+        self.enabled = threads > 0 and max_queue > 0
+        self._jobs = deque(maxlen=max(1, max_queue))
+        self._cond = threading.Condition()
+        self._active = 0
+        self._workers = []
+        self._local = threading.local()
+        self.block_pool = ThreadPoolExecutor(max(1, threads),
+                                             initializer=self._mark)
+        self.render_pool = ThreadPoolExecutor(max(1, threads),
+                                              initializer=self._mark)
+
+    def _mark(self):
+        '''Mark the current thread as loading in the background'''
+        self._local.background = True
+
+    def in_background(self):
+        '''Whether the current thread loads in the background'''
+        return getattr(self._local, 'background', False)
+
+    def _start(self):
+        '''Start the threads on first use, after any fork'''
+        for _ in range(self.threads - len(self._workers)):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def foreground(self):
+        '''Pause prefetching while a request is served
+
+        :returns: a context manager for the foreground request
+        '''
+        return _Foreground(self)
+
+    def request(self, datasource, x0, x1, y0, y1, z0, z1, w, load=None):
+        '''Queue the neighbours of a served cutout
+
+        :param datasource: the datasource of the served cutout
+        :param x0, x1, y0, y1: the full resolution bounds of the cutout
+        :param z0, z1: the first and after the last served plane
+        :param w: the mip level of the cutout
+        :param load: called with the bounds and plane of each neighbour,
+            or the load_cutout of the datasource by default
+        '''
+        # Loads that are not cached would be read again anyway
+        if not self.enabled or not datasource.cache_reads:
+            return
+        if load is None:
+            load = datasource.load_cutout
+        [size_x, size_y, size_z] = datasource.get_boundaries()[:3]
+        dx = x1 - x0
+        dy = y1 - y0
+        # Neighbours in the same plane have the lowest priority
+        jobs = []
+        for x, y in ((x0 - dx, y0), (x1, y0), (x0, y0 - dy), (x0, y1)):
+            # Keep the neighbours that overlap the volume
+            if x < size_x and x + dx > 0 and y < size_y and y + dy > 0:
+                jobs.append((x, x + dx, y, y + dy, z0, w))
+        # The nearest planes are loaded first
+        for step in range(self.depth, 0, -1):
+            for z in (z1 - 1 + step, z0 - step):
+                if 0 <= z < size_z:
+                    jobs.append((x0, x1, y0, y1, z, w))
+        with self._cond:
+            if len(self._workers) < self.threads:
+                self._start()
+            for bounds in jobs:
+                self._jobs.append((load, bounds))
+            self._cond.notify_all()
+
+    def _work(self):
+        self._mark()
+        while True:
+            with self._cond:
+                while not self._jobs or self._active:
+                    self._cond.wait()
+                load, bounds = self._jobs.pop()
+            try:
+                # Loading the cutout stores all its tiles in the cache
+                load(*bounds)
+            except Exception:
+                logging.debug('Cannot prefetch %s' % str(bounds))
+
+
+class _Foreground(object):
+    '''Counts the requests served in the foreground'''
+
+    def __init__(self, prefetcher):
+        self._prefetcher = prefetcher
+
+    def __enter__(self):
+        with self._prefetcher._cond:
+            self._prefetcher._active += 1
+
+    def __exit__(self, *args):
+        with self._prefetcher._cond:
+            self._prefetcher._active -= 1
+            self._prefetcher._cond.notify_all()
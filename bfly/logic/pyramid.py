@@ -0,0 +1,211 @@
+""" Builds stored mip levels for datasources without them
+
+Each level halves the one before it. Images are area averaged, while
+segmentation labels are subsampled so that no new label values appear.
+A regular image stack gets Mojo-style ``pyramid/w=N/z=N`` folders of
+tiles, and an HDF5 dataset gets one more dataset for every level.
+"""
+
+import os
+import cv2
+import shutil
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+'''The (x, y) tile shape used to count the levels of HDF5 datasets'''
+HDF5_TILE = (512, 512)
+
+
+def is_labels(dtype):
+    '''Whether tiles of a dtype hold segmentation labels
+
+    :param dtype: the numpy dtype of the tiles
+    '''
+    return np.dtype(dtype).itemsize > 2 and np.dtype(dtype).kind in 'iu'
+
+
+def downsample(tile, labels=False):
+    '''Halve the width and height of a tile
+
+    :param tile: a 2D numpy array
+    :param labels: whether to subsample rather than average
+    :returns: the tile at the next mip level
+    '''
+    if labels:
+        return np.ascontiguousarray(tile[::2, ::2])
+    shape = ((tile.shape[1] + 1) // 2, (tile.shape[0] + 1) // 2)
+    return cv2.resize(tile, shape, interpolation=cv2.INTER_AREA)
+
+
+def combine(children, blocksize, dtype, across=2):
+    '''Place a square of tiles side by side in one array
+
+    :param children: a dictionary of tiles by (dx, dy) below across
+    :param blocksize: the (x, y) shape of every tile
+    :param dtype: the numpy dtype of every tile
+    :param across: the number of tiles along each side of the square
+    :returns: an array across times the blocksize with zeros for
+        missing tiles
+    '''
+    [bx, by] = [int(b) for b in blocksize[:2]]
+    canvas = np.zeros((across * by, across * bx), dtype=dtype)
+    for (dx, dy), child in children.items():
+        if child is None:
+            continue
+        [h, w] = [min(by, child.shape[0]), min(bx, child.shape[1])]
+        canvas[dy * by:dy * by + h, dx * bx:dx * bx + w] = child[:h, :w]
+    return canvas
+
+
+def merge(children, blocksize, dtype):
+    '''Halve a square of four tiles into one tile
+
+    :param children: a dictionary of tiles by (dx, dy) from 0 to 1
+    :param blocksize: the (x, y) shape of every tile
+    :param dtype: the numpy dtype of every tile
+    :returns: the tile at the next mip level
+    '''
+    canvas = combine(children, blocksize, dtype)
+    return downsample(canvas, is_labels(dtype))
+
+
+def count_levels(shape, blocksize):
+    '''Count the levels until one tile covers the whole plane
+
+    :param shape: the (x, y) size of the full resolution plane
+    :param blocksize: the (x, y) shape of every tile
+    '''
+    tiles = max(-(-int(s) // int(b)) for s, b in zip(shape, blocksize))
+    return int(np.ceil(np.log2(tiles))) if tiles > 1 else 1
+
+
+def build_images(datasource, levels=None, threads=1):
+    '''Write pyramid tiles of a regular image stack
+
+    Every level is written to a hidden folder and renamed once all its
+    planes are written, so servers never find a level built in part.
+
+    :param datasource: a :class:`RegularImageStack`
+    :param levels: the number of levels above full resolution
+    :param threads: the number of planes to build at once
+    '''
+    [nx, ny, nz] = [len(i) for i in datasource._indices]
+    blocksize = datasource.blocksize
+    if not levels:
+        levels = count_levels((nx * blocksize[0], ny * blocksize[1]),
+                              blocksize)
+
+    def level_folders(w):
+        final = os.path.dirname(os.path.dirname(
+            datasource.pyramid_path(0, 0, 0, w)))
+        [parent, name] = os.path.split(final)
+        return final, os.path.join(parent, '.' + name)
+
+    for w in range(1, levels + 1):
+        building = level_folders(w)[1]
+        if os.path.isdir(building):
+            shutil.rmtree(building)
+
+    def build_plane(z):
+        [cols, rows] = [nx, ny]
+        # Tiles of the level below, read once from the source files
+        # and kept in memory so lossy files are never decoded again
+        tiles = {}
+        for y in range(rows):
+            for x in range(cols):
+                tile = datasource.read_file(
+                    datasource.block_path(x, y, z, 0), 0)
+                if tile is None:
+                    logging.warning('Cannot read tile %d, %d of plane %d'
+                                    % (x, y, z))
+                tiles[x, y] = tile
+        for w in range(1, levels + 1):
+            [final, building] = level_folders(w)
+            [cols, rows] = [-(-cols // 2), -(-rows // 2)]
+            merged = {}
+            for y in range(rows):
+                for x in range(cols):
+                    # Missing tiles of the level below stay zero
+                    children = dict(
+                        ((dx, dy), tiles.get((2 * x + dx, 2 * y + dy)))
+                        for dy in (0, 1) for dx in (0, 1))
+                    tile = merge(children, blocksize, datasource.dtype)
+                    path = datasource.pyramid_path(x, y, z, w)
+                    path = building + path[len(final):]
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    cv2.imwrite(path, tile)
+                    merged[x, y] = tile
+            tiles = merged
+        logging.info('Built %d levels of plane %d' % (levels, z))
+
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(build_plane, range(nz)))
+
+    # Show the complete levels from the lowest, replacing old ones
+    for w in range(1, levels + 1):
+        [final, building] = level_folders(w)
+        if os.path.isdir(final):
+            shutil.rmtree(final)
+        os.rename(building, final)
+    return levels
+
+
+def build_hdf5_file(filename, dataset_path, levels, labels):
+    '''Write one dataset per level to an HDF5 file
+
+    :param filename: the HDF5 file with the dataset
+    :param dataset_path: the path of the full resolution dataset
+    :param levels: the number of levels above full resolution
+    :param labels: whether to subsample rather than average
+    :returns: the number of levels written
+    '''
+    import h5py
+    from bfly.input.hdf5 import scale_path
+
+    with h5py.File(filename, 'a') as fd:
+        full = fd[dataset_path]
+        if not levels:
+            levels = count_levels(full.shape[:0:-1], HDF5_TILE)
+        source = full
+        for w in range(1, levels + 1):
+            name = scale_path(dataset_path, w)
+            if name in fd:
+                del fd[name]
+            shape = (source.shape[0],) + tuple(
+                (s + 1) // 2 for s in source.shape[1:])
+            target = fd.create_dataset(
+                name, shape, dtype=source.dtype,
+                chunks=(1,) + tuple(min(s, 512) for s in shape[1:]),
+                compression='gzip')
+            for z in range(shape[0]):
+                target[z] = downsample(source[z], labels)
+            source = target
+    logging.info('Built %d levels of %s' % (levels, filename))
+    return levels
+
+
+def build_hdf5(datasource, levels=None, threads=1):
+    '''Write one dataset per level to each file of an HDF5 source
+
+    HDF5 serializes reads, writes and compression in one process, so the
+    files are built at the same time in separate processes.
+
+    :param datasource: an :class:`HDF5DataSource`
+    :param levels: the number of levels above full resolution
+    :param threads: the number of files to build at once
+    '''
+    from bfly.input.hdf5 import K_FILENAME, K_DATASET_PATH
+    from bfly.input.hdf5 import FILES
+
+    # Files open to read cannot be opened again to write
+    FILES.close()
+    labels = is_labels(datasource.dtype)
+    jobs = [(d[K_FILENAME], d[K_DATASET_PATH], levels, labels)
+            for d in datasource._dataset]
+    if threads <= 1 or len(jobs) <= 1:
+        built = [build_hdf5_file(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(min(threads, len(jobs))) as pool:
+            built = list(pool.map(build_hdf5_file, *zip(*jobs)))
+    return min(built)
@@ -13,6 +13,19 @@ PORT : int
 MAX_CACHE_SIZE : int
     Cache 1024^3 bytes or 1024^2 times 'max-cache-size'\
 in megabytes from :data:`config`
+CACHE_SHARDS : int
+    Split the cache in 16 or 'cache-shards' locked partitions
+CACHE_POLICY : str
+    Evict tiles with 'lru' or 'cache-policy' from :data:`config`
+WORKER_THREADS : int
+    Load images on one thread per core or 'worker-threads'
+PROCESSES : int
+    Fork 1 or 'processes' servers sharing the tile cache
+DISK_CACHE_PATH : str
+    Keep tiles on disk in 'disk-cache-path' from :data:`config`
+DISK_CACHE_SIZE : int
+    Keep 10 * 1024^3 bytes or 1024^2 times 'disk-cache-size'\
+in megabytes from :data:`config` on disk
 BFLY_CONFIG : dict
     Values from 'bfly' key of :data:`config`
 config : dict
@@ -46,6 +59,9 @@ DB_PATH = BFLY_CONFIG.get('db-path', 'bfly.db')
 DB_TYPE = BFLY_CONFIG.get('db-type', 'Nodb')
 DB_PORT = BFLY_CONFIG.get('db-port', 27017)
 
+# Path to the folder of saved datasource indexes
+INDEX_PATH = BFLY_CONFIG.get('index-path', 'bfly.index')
+
 # Path to root edit directory
 EDIT_PATH = BFLY_CONFIG.get('edit-path', os.sep)
 
@@ -56,12 +72,69 @@ LOG_LEVEL = BFLY_CONFIG.get('log-level', 'INFO')
 # Maximum size of the cache in MiB: 1 GiB by default
 _max_cache = BFLY_CONFIG.get('max-cache-size', 1024)
 MAX_CACHE_SIZE = int(_max_cache) * (1024**2)
+# Number of independently locked partitions of the cache
+CACHE_SHARDS = int(BFLY_CONFIG.get('cache-shards', 16))
+# Replacement policy of the cache: lru or the scan-resistant 2q
+CACHE_POLICY = str(BFLY_CONFIG.get('cache-policy', 'lru')).lower()
+# Keep tiles at or above this mip level pinned in the cache
+_pin_level = BFLY_CONFIG.get('cache-pin-level', None)
+CACHE_PIN_LEVEL = None if _pin_level is None else int(_pin_level)
+# Mip levels to pin for specific datapaths, overriding the default
+CACHE_PIN_LEVELS = BFLY_CONFIG.get('cache-pin-levels', {})
+# Fraction of the cache that pinned tiles may fill
+CACHE_PIN_FRACTION = float(BFLY_CONFIG.get('cache-pin-fraction', 0.25))
+# Maximum size in MiB of the parsed tilespec layers: 2 GiB by default
+_max_layer_cache = BFLY_CONFIG.get('layer-cache-size', 2048)
+LAYER_CACHE_SIZE = int(_max_layer_cache) * (1024**2)
+# Directory of the persistent tile cache, disabled by default
+DISK_CACHE_PATH = BFLY_CONFIG.get('disk-cache-path', None)
+# Maximum size of the persistent cache in MiB: 10 GiB by default
+_max_disk_cache = BFLY_CONFIG.get('disk-cache-size', 10240)
+DISK_CACHE_SIZE = int(_max_disk_cache) * (1024**2)
+# Compression level of the persistent cache from 0 to 9
+DISK_CACHE_LEVEL = int(BFLY_CONFIG.get('disk-cache-level', 1))
+# Maximum size of the encoded response cache in MiB
+_max_responses = BFLY_CONFIG.get('response-cache-size', 256)
+RESPONSE_CACHE_SIZE = int(_max_responses) * (1024**2)
+# Seconds that clients may reuse an image response
+RESPONSE_MAX_AGE = int(BFLY_CONFIG.get('response-max-age', 3600))
+# Number of threads loading and encoding images: one per core
+_cpu_count = os.cpu_count() or 1
+WORKER_THREADS = int(BFLY_CONFIG.get('worker-threads', _cpu_count))
+# Number of threads loading the blocks of cutouts: one per core
+BLOCK_THREADS = int(BFLY_CONFIG.get('block-threads', _cpu_count))
+# Number of threads warping the tiles of montages: one per core
+RENDER_THREADS = int(BFLY_CONFIG.get('render-threads', _cpu_count))
+# Number of forked server processes sharing one tile cache: 0 for one
+# per core, or 1 to serve from a single process
+_processes = int(BFLY_CONFIG.get('processes', 1))
+PROCESSES = _processes if _processes > 0 else _cpu_count
+# Maximum size in MiB of tiles each process cannot share: 128 MiB
+_max_process_cache = BFLY_CONFIG.get('process-cache-size', 128)
+PROCESS_CACHE_SIZE = int(_max_process_cache) * (1024**2)
+# Whether to load neighbouring tiles and planes in the background
+PREFETCH = is_yes(BFLY_CONFIG.get('prefetch', False))
+# Number of background threads that prefetch tiles
+PREFETCH_THREADS = int(BFLY_CONFIG.get('prefetch-threads', 2))
+# Number of planes to prefetch above and below each request
+PREFETCH_DEPTH = int(BFLY_CONFIG.get('prefetch-depth', 2))
+# Most cutouts waiting to be prefetched, dropping the oldest
+PREFETCH_QUEUE = int(BFLY_CONFIG.get('prefetch-queue', 64))
+# Most HDF5 files kept open between requests
+HDF5_HANDLES = int(BFLY_CONFIG.get('hdf5-handles', 32))
+# Size in MiB of the decompressed chunks kept by each open HDF5 file
+_hdf5_chunk_cache = BFLY_CONFIG.get('hdf5-chunk-cache', 16)
+HDF5_CHUNK_CACHE = int(_hdf5_chunk_cache) * (1024**2)
+# Most tiled TIFF files kept open between requests
+TIFF_HANDLES = int(BFLY_CONFIG.get('tiff-handles', 32))
 # Maximum size of a single block in MiB: 1 MiB by default
 _max_block = BFLY_CONFIG.get('max-block-size', 1)
 MAX_BLOCK_SIZE = int(_max_block) * (1024**2)
 '''Queries that will enable flags'''
 ASSENT_LIST = BFLY_CONFIG.get("assent-list", ('yes', 'y', 'true'))
 ALWAYS_SUBSAMPLE = bool(BFLY_CONFIG.get("always-subsample", True))
+# Whether jpeg tiles decode at a reduced size when zoomed out
+REDUCED_DECODE = is_yes(BFLY_CONFIG.get("reduced-decode", True))
 _image_resize_method = BFLY_CONFIG.get("image-resize-method", "linear")
 
 '''Interpolation method to use upon resizing'''
@@ -81,7 +154,8 @@ SUPPORTED_IMAGE_VIEWS = ('grayscale','colormap','rgb')
 '''List of datasources to try, in order, given a path'''
 DATASOURCES = BFLY_CONFIG.get(
     "datasource",
-    ["hdf5", "tilespecs", "multibeam", "mojo", "regularimagestack"])
+    ["memmap", "chunkstore", "tiledtiff", "hdf5", "tilespecs",
+     "multibeam", "mojo", "regularimagestack"])
 
 # Paths must start with one of the following allowed paths
 ALLOWED_PATHS = BFLY_CONFIG.get('allowed-paths', [os.sep])
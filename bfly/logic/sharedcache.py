@@ -0,0 +1,286 @@
+""" A tile cache shared by all forked server processes
+
+The tiles live in one anonymous shared memory slab, made before the
+server forks, so every worker process reads and writes the same tiles.
+The slab is split into small pages, and each tile takes only as many
+pages as its bytes need. New tiles are written at a head that moves
+around the slab like a ring, replacing the tiles under it. Tiles that
+are pinned, or that were read since they were written, are stepped over
+a few times before they are replaced.
+
+Each key hashes to one small set of records in a table that gives the
+pages of its tile. Each group of sets is guarded by a lock shared
+between the processes, and one more lock guards the head.
+
+Only numpy arrays up to a fraction of the slab are shared. Any other
+value is kept in a smaller cache that belongs to each process.
+"""
+
+import mmap
+import time
+import hashlib
+import multiprocessing
+import numpy as np
+
+'''Number of records in each set'''
+WAYS = 8
+
+'''Most locks shared between processes'''
+MAX_LOCKS = 64
+
+'''Stamp added to pinned tiles so they are evicted last'''
+PINNED = 1 << 62
+
+'''Bytes in each page of the slab'''
+PAGE = 4096
+
+'''Average tile size used to count the records of the table'''
+MEAN_TILE = 64 * 1024
+
+'''Largest shared tile as a fraction of the slab'''
+MAX_TILE_FRACTION = 8
+
+'''Times the head steps over tiles that are pinned or were read'''
+MAX_SKIPS = 16
+
+'''The record kept for each tile in the slab'''
+RECORD = np.dtype([
+    ('key', 'S20'),
+    ('used', '<i8'),
+    ('written', '<i8'),
+    ('page', '<i8'),
+    ('nbytes', '<i8'),
+    ('dtype', 'S8'),
+    ('ndim', '<i8'),
+    ('shape', '<i8', (3,)),
+])
+
+
+class SharedTileCache(object):
+    '''A ring of variable sized tiles in shared memory
+
+    :param max_size: the total number of bytes in the shared slab
+    :param local: a :class:`TileCache` for tiles that cannot be shared
+    '''
+
+    def __init__(self, max_size, local):
+        self.max_size = max_size
+        self.n_pages = max(1, max_size // PAGE)
+        self.max_tile = self.n_pages * PAGE // MAX_TILE_FRACTION
+        self.n_sets = max(1, max_size // (MEAN_TILE * WAYS))
+        n_records = self.n_sets * WAYS
+        self._local = local
+        self._slab = mmap.mmap(-1, self.n_pages * PAGE)
+        self._table_map = mmap.mmap(-1, n_records * RECORD.itemsize)
+        self._table = np.frombuffer(self._table_map, dtype=RECORD)
+        # The record of the last tile written to each page
+        self._owner_map = mmap.mmap(-1, self.n_pages * 8)
+        self._owner = np.frombuffer(self._owner_map, dtype='<i8')
+        self._owner[:] = -1
+        # The next free page of the ring
+        self._head_map = mmap.mmap(-1, 8)
+        self._head = np.frombuffer(self._head_map, dtype='<i8')
+        n_locks = min(self.n_sets, MAX_LOCKS)
+        self._locks = [multiprocessing.Lock() for _ in range(n_locks)]
+        self._head_lock = multiprocessing.Lock()
+        # Counters of this process only
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _find(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).digest()
+        first = int.from_bytes(digest[:8], 'little') % self.n_sets
+        return digest, first * WAYS, self._lock_of(first * WAYS)
+
+    def _lock_of(self, record):
+        return self._locks[(record // WAYS) % len(self._locks)]
+
+    def _lookup(self, digest, start):
+        ways = self._table[start:start + WAYS]
+        match = np.flatnonzero((ways['key'] == digest) & (ways['nbytes'] > 0))
+        return start + int(match[0]) if len(match) else None
+
+    def get(self, key, default=None):
+        '''Get a copy of a tile and mark it as most recently used
+
+        :param key: any key with a stable ``repr``
+        :param default: returned if the key is not in the cache
+        '''
+        digest, start, lock = self._find(key)
+        with lock:
+            record = self._lookup(digest, start)
+            if record is not None:
+                value = self._read(record)
+        if record is None:
+            value = self._local.get(key)
+            if value is None:
+                self.misses += 1
+                return default
+        self.hits += 1
+        return value
+
+    def _read(self, record):
+        '''Copy a tile out of the slab while holding its lock'''
+        table = self._table
+        pinned = int(table['used'][record]) & PINNED
+        table['used'][record] = time.monotonic_ns() | pinned
+        offset = int(table['page'][record]) * PAGE
+        dtype = np.dtype(table['dtype'][record].decode('ascii'))
+        shape = tuple(table['shape'][record][:table['ndim'][record]])
+        count = int(table['nbytes'][record]) // dtype.itemsize
+        value = np.frombuffer(self._slab, dtype, count, offset).copy()
+        return value.reshape(shape)
+
+    def _pages(self, record):
+        '''The first and last page of a tile, or None if it is empty'''
+        nbytes = int(self._table['nbytes'][record])
+        if nbytes <= 0:
+            return None
+        first = int(self._table['page'][record])
+        return first, first + -(-nbytes // PAGE)
+
+    def _covering(self, first, last):
+        '''The records of tiles on the pages from first to last'''
+        records = np.unique(self._owner[first:last])
+        return [int(r) for r in records if r >= 0]
+
+    def _keep(self, record, first, last):
+        '''Whether to step over a tile, giving it one more chance'''
+        with self._lock_of(record):
+            pages = self._pages(record)
+            if pages is None or pages[1] <= first or last <= pages[0]:
+                return None
+            used = int(self._table['used'][record])
+            if used & PINNED:
+                return pages[1]
+            if used > int(self._table['written'][record]):
+                # Keep tiles read since they were written for one more lap
+                self._table['written'][record] = used
+                return pages[1]
+        return None
+
+    def _evict(self, record, first, last):
+        '''Remove a tile on the pages from first to last'''
+        with self._lock_of(record):
+            pages = self._pages(record)
+            if pages is None or pages[1] <= first or last <= pages[0]:
+                return
+            self._table['nbytes'][record] = 0
+            self._table['used'][record] = 0
+            self.evictions += 1
+
+    def _reserve(self, n_pages):
+        '''Find pages for a new tile while holding the head lock'''
+        for skip in range(MAX_SKIPS + 1):
+            first = int(self._head[0])
+            if first + n_pages > self.n_pages:
+                first = 0
+            last = first + n_pages
+            covering = self._covering(first, last)
+            if skip == MAX_SKIPS:
+                break
+            kept = [self._keep(r, first, last) for r in covering]
+            kept = [end for end in kept if end is not None]
+            if not kept:
+                break
+            # Step over the tiles to keep
+            self._head[0] = max(kept) % self.n_pages
+        for record in covering:
+            self._evict(record, first, last)
+        self._head[0] = last % self.n_pages
+        return first, last
+
+    def set(self, key, value, pinned=False):
+        '''Store a tile in the slab, or in this process if unshareable
+
+        :param key: any key with a stable ``repr``
+        :param value: the value to store, usually a numpy array
+        :param pinned: whether to evict the tile after all others
+        '''
+        shareable = isinstance(value, np.ndarray) and value.ndim <= 3
+        if not shareable or value.nbytes > self.max_tile:
+            self._local.set(key, value, pinned)
+            return
+        value = np.ascontiguousarray(value)
+        digest, start, lock = self._find(key)
+        with self._head_lock:
+            [first, last] = self._reserve(max(1, -(-value.nbytes // PAGE)))
+            target = np.frombuffer(self._slab, np.uint8, value.nbytes,
+                                   first * PAGE)
+            target[:] = value.reshape(-1).view(np.uint8)
+            with lock:
+                table = self._table
+                record = self._lookup(digest, start)
+                if record is None:
+                    # Replace the least recently used record of the set
+                    ways = table[start:start + WAYS]
+                    record = start + int(np.argmin(ways['used']))
+                    if table['nbytes'][record] > 0:
+                        self.evictions += 1
+                now = time.monotonic_ns()
+                table['key'][record] = digest
+                table['used'][record] = now | (PINNED if pinned else 0)
+                table['written'][record] = now
+                table['page'][record] = first
+                table['nbytes'][record] = value.nbytes
+                table['dtype'][record] = value.dtype.str.encode('ascii')
+                table['ndim'][record] = value.ndim
+                table['shape'][record, :value.ndim] = value.shape
+            self._owner[first:last] = record
+
+    def pop(self, key):
+        '''Remove a key from the cache if present'''
+        digest, start, lock = self._find(key)
+        with lock:
+            record = self._lookup(digest, start)
+            if record is not None:
+                self._table['nbytes'][record] = 0
+                self._table['used'][record] = 0
+        self._local.pop(key)
+
+    def clear(self):
+        '''Remove every entry from the cache'''
+        with self._head_lock:
+            for lock in self._locks:
+                lock.acquire()
+            try:
+                self._table['nbytes'] = 0
+                self._table['used'] = 0
+                self._owner[:] = -1
+                self._head[0] = 0
+            finally:
+                for lock in self._locks:
+                    lock.release()
+        self._local.clear()
+
+    @property
+    def size(self):
+        '''The number of bytes currently held in the cache'''
+        return int(self._table['nbytes'].sum()) + self._local.size
+
+    def stats(self):
+        '''Get the counters of this process and the size of the slab
+
+        :returns: a dictionary of counters and sizes
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': self.size,
+            'count': len(self),
+            'max_size': self.max_size,
+            'policy': 'shared',
+            'local': self._local.stats(),
+        }
+
+    def __contains__(self, key):
+        digest, start, lock = self._find(key)
+        with lock:
+            if self._lookup(digest, start) is not None:
+                return True
+        return key in self._local
+
+    def __len__(self):
+        return int((self._table['nbytes'] > 0).sum()) + len(self._local)
@@ -0,0 +1,91 @@
+""" Saves the index of each datasource in a sidecar file
+
+Indexing a datasource can take minutes, so the results are written as
+json to a file named by the datapath. The file records the modification
+time and size of every source file, and is only used while none of them
+have changed and the :data:`VERSION` matches.
+"""
+
+import os
+import json
+import hashlib
+import logging
+from bfly.logic import settings
+
+'''Bump the version to ignore all sidecars of an older format'''
+VERSION = 4
+
+
+def fingerprint(sources):
+    '''Get the modification time and size of source files
+
+    :param sources: a list of paths to files or folders
+    :returns: a list of [path, mtime, size] for each path
+    '''
+    found = []
+    for path in sources:
+        try:
+            stat = os.stat(path)
+            found.append([path, stat.st_mtime, stat.st_size])
+        except OSError:
+            found.append([path, None, None])
+    return found
+
+
+def _filename(datapath):
+    name = hashlib.sha1(datapath.encode('utf-8')).hexdigest()
+    return os.path.join(settings.INDEX_PATH, name + '.json')
+
+
+def load(datapath, kind, sources):
+    '''Load an index if its source files are unchanged
+
+    :param datapath: the path of the datasource
+    :param kind: the name of the datasource class
+    :param sources: the paths whose changes invalidate the index
+    :returns: the saved index dictionary or None
+    '''
+    if not settings.INDEX_PATH:
+        return None
+    try:
+        with open(_filename(datapath), 'r') as f:
+            saved = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if saved.get('version') != VERSION:
+        return None
+    if saved.get('kind') != kind or saved.get('datapath') != datapath:
+        return None
+    if saved.get('sources') != fingerprint(sources):
+        return None
+    return saved['index']
+
+
+def save(datapath, kind, sources, index):
+    '''Save an index with the state of its source files
+
+    :param datapath: the path of the datasource
+    :param kind: the name of the datasource class
+    :param sources: the paths whose changes invalidate the index
+    :param index: a dictionary that can be written as json
+    '''
+    if not settings.INDEX_PATH:
+        return
+    filename = _filename(datapath)
+    saved = {
+        'version': VERSION,
+        'kind': kind,
+        'datapath': datapath,
+        'sources': fingerprint(sources),
+        'index': index,
+    }
+    try:
+        if not os.path.isdir(settings.INDEX_PATH):
+            os.makedirs(settings.INDEX_PATH)
+        # Write then rename so readers never see part of a file
+        tmp_file = '%s.%d' % (filename, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(saved, f)
+        os.rename(tmp_file, filename)
+    except (IOError, OSError, TypeError, ValueError):
+        logging.warning('Cannot save index of %s' % datapath)
@@ -0,0 +1,68 @@
+""" Finds the boxes that intersect a rectangle
+
+The tiles of a montaged layer are indexed by their bounding boxes in a
+uniform grid of cells about the size of one tile. Each cell lists the
+boxes that overlap it, so a query only visits the cells under the
+rectangle and then keeps the boxes that truly intersect it.
+"""
+
+import numpy as np
+
+
+class GridIndex(object):
+    '''A uniform grid of the boxes overlapping each cell
+
+    :param boxes: an (n, 4) array of x0, x1, y0, y1 for each box
+    :param cell: the side of each cell, the median box side by default
+    '''
+
+    def __init__(self, boxes, cell=None):
+        self.boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        [x0, x1, y0, y1] = self.boxes.T
+        if cell is None:
+            sides = np.concatenate([x1 - x0, y1 - y0])
+            cell = float(np.median(sides)) if len(sides) else 1.0
+        self.cell = max(cell, 1.0)
+        self.origin = (x0.min(), y0.min()) if len(x0) else (0.0, 0.0)
+        cells = {}
+        [i0, i1] = self._cells(x0, x1, 0)
+        [j0, j1] = self._cells(y0, y1, 1)
+        for box in range(len(self.boxes)):
+            for j in range(j0[box], j1[box] + 1):
+                for i in range(i0[box], i1[box] + 1):
+                    cells.setdefault((i, j), []).append(box)
+        self._cells_of = dict(
+            (key, np.array(value)) for key, value in cells.items())
+        # The last cells holding any box
+        self._last = (max(i1) if len(i1) else 0, max(j1) if len(j1) else 0)
+
+    def _cells(self, start, stop, axis):
+        '''Get the first and last cells covering a range'''
+        first = np.floor((np.asarray(start) - self.origin[axis]) / self.cell)
+        last = np.floor((np.asarray(stop) - self.origin[axis]) / self.cell)
+        return first.astype(int), last.astype(int)
+
+    def query(self, x0, x1, y0, y1):
+        '''Find the boxes that intersect a rectangle
+
+        :param x0, x1, y0, y1: the bounds of the rectangle
+        :returns: a sorted array of the indexes of the boxes
+        '''
+        # Only visit cells that may hold boxes
+        [i0, i1] = self._cells(x0, x1, 0)
+        [j0, j1] = self._cells(y0, y1, 1)
+        [i0, j0] = [max(i0, 0), max(j0, 0)]
+        [i1, j1] = [min(i1, self._last[0]), min(j1, self._last[1])]
+        found = [self._cells_of[i, j]
+                 for j in range(j0, j1 + 1)
+                 for i in range(i0, i1 + 1)
+                 if (i, j) in self._cells_of]
+        if not found:
+            return np.zeros(0, dtype=int)
+        found = np.unique(np.concatenate(found))
+        [bx0, bx1, by0, by1] = self.boxes[found].T
+        inside = (bx0 < x1) & (x0 < bx1) & (by0 < y1) & (y0 < by1)
+        return found[inside]
+
+    def __len__(self):
+        return len(self.boxes)
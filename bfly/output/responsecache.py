@@ -0,0 +1,76 @@
+''' A cache of encoded image responses
+
+Viewers ask for the same tile urls again and again, so the final bytes
+of each image response are kept by the normalized request. Repeated
+requests skip loading and encoding, and clients holding the same strong
+ETag get an empty 304 response.
+'''
+
+import hashlib
+from bfly.logic import settings
+from bfly.logic.cache import TileCache
+
+
+class EncodedResponse(object):
+    '''The encoded body of a response with its headers
+
+    :param content: the bytes of the response body
+    :param content_type: the mime type of the body
+    '''
+
+    def __init__(self, content, content_type):
+        self.content = content
+        self.content_type = content_type
+        digest = hashlib.sha1(content).hexdigest()
+        self.etag = '"%s"' % digest
+
+    @property
+    def nbytes(self):
+        return len(self.content)
+
+
+class ResponseCache(object):
+    '''A bounded cache of encoded responses
+
+    :param max_size: the total number of bytes to keep in the cache
+    :param max_age: the seconds clients may reuse a response
+    '''
+
+    def __init__(self, max_size, max_age):
+        self.max_age = max_age
+        self._cache = TileCache(max_size, settings.CACHE_SHARDS)
+
+    def get(self, key):
+        '''Get a cached response for a normalized request
+
+        :param key: a hashable tuple of all request parameters
+        :returns: the :class:`EncodedResponse` or None
+        '''
+        return self._cache.get(key)
+
+    def set(self, key, content, content_type):
+        '''Cache the encoded content for a normalized request
+
+        :param key: a hashable tuple of all request parameters
+        :param content: the bytes of the response body
+        :param content_type: the mime type of the body
+        :returns: the new :class:`EncodedResponse`
+        '''
+        response = EncodedResponse(content, content_type)
+        self._cache.set(key, response)
+        return response
+
+    def respond(self, handler, response):
+        '''Write a response, or 304 if the client has it already
+
+        :param handler: the tornado request handler
+        :param response: an :class:`EncodedResponse`
+        '''
+        handler.set_header('Etag', response.etag)
+        handler.set_header('Cache-Control',
+                           'public, max-age=%d' % self.max_age)
+        if handler.check_etag_header():
+            handler.set_status(304)
+            return
+        handler.set_header('Content-Type', response.content_type)
+        handler.write(response.content)
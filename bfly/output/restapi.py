@@ -1,4 +1,5 @@
 from tornado.web import RequestHandler
+import tornado.gen
 from urllib.error import HTTPError
 import tifffile
 import numpy as np
@@ -8,6 +9,7 @@ import json
 import cv2
 
 from bfly.logic import settings
+from .responsecache import EncodedResponse
 
 
 class RestAPIHandler(RequestHandler):
@@ -45,18 +47,23 @@ class RestAPIHandler(RequestHandler):
     Y = "y"
     Z = "z"
 
-    def initialize(self, core):
+    def initialize(self, core, responses, executor):
         '''Override of RequestHandler.initialize
 
         Initializes the RestAPI request handler
 
         :param core: the butterfly.core instance used to fetch images
+        :param responses: the cache of encoded image responses
+        :param executor: the thread pool that loads and encodes images
         '''
         self.core = core
+        self.responses = responses
+        self.executor = executor
 
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header('Access-Control-Allow-Methods', 'GET')
 
+    @tornado.gen.coroutine
     def get(self, command):
         '''Handle an HTTP GET request'''
 
@@ -73,7 +80,7 @@ class RestAPIHandler(RequestHandler):
             elif command == "channel_metadata":
                 result = self.get_channel_metadata()
             elif command == "data":
-                self.get_data()
+                yield self.get_data()
                 return
             elif command == "mask":
                 self.get_mask()
@@ -200,6 +207,7 @@ class RestAPIHandler(RequestHandler):
         result = self.get_query_argument(qparam, 0)
         return self._try_typecast_int(qparam, result)
 
+    @tornado.gen.coroutine
     def get_data(self):
         channel = self._get_channel_config()
         dtype = channel[self.DATA_TYPE]
@@ -222,26 +230,44 @@ class RestAPIHandler(RequestHandler):
         resolution = self._get_int_query_argument(self.Q_RESOLUTION)
         view = self._get_list_query_argument(self.Q_VIEW, defaultView, views)
 
-        slice_define = [channel[self.PATH], [x, y, z], [width, height, 1]]
-    #    rh_logger.logger.report_event("Encoding image as dtype %s" % repr(dtype))
-        vol = self.core.get(*slice_define, w=resolution, view=view)
-        self.set_header("Content-Type", "image/"+fmt)
+        # Reuse the encoded image for any identical request
+        cache_key = (channel[self.PATH], x, y, z, width, height,
+                     resolution, view, fmt)
+        response = self.responses.get(cache_key)
+        if response is None:
+            slice_define = [channel[self.PATH], [x, y, z], [width, height, 1]]
+
+            def load_and_encode():
+                # Send the stored file of a whole block as it is
+                content = self.core.get_file(*slice_define, w=resolution,
+                                             view=view, fmt=fmt)
+                if content is not None:
+                    # The file is kept in the tile cache instead
+                    return EncodedResponse(content, "image/"+fmt)
+                vol = self.core.get(*slice_define, w=resolution, view=view)
+                return self.responses.set(cache_key, self._encode(vol, fmt),
+                                          "image/"+fmt)
+
+            # Keep the IOLoop free while the image is loaded and encoded
+            response = yield self.executor.submit(load_and_encode)
+
+        self.responses.respond(self, response)
+
+    def _encode(self, vol, fmt):
+        '''Encode a volume as the bytes of an image format'''
         if fmt in ['zip']:
-            output = io.StringIO()
+            output = io.BytesIO()
             volstring = vol[:,:,0].T.astype(np.uint32).tostring('F')
             output.write(zlib.compress(volstring))
-            content = output.getvalue()
+            return output.getvalue()
         elif fmt in ['tif','tiff']:
-            output = io.StringIO()
+            output = io.BytesIO()
             tiffvol = vol[:,:,0].astype(np.uint32)
             tifffile.imsave(output, tiffvol)
-            content = output.getvalue()
-        else:
-            if vol.dtype.itemsize == 4:
-                vol = vol.view(np.uint8).reshape(vol.shape[0], vol.shape[1], 4)
-            content = cv2.imencode(  "." + fmt, vol)[1].tostring()
-
-        self.write(content)
+            return output.getvalue()
+        if vol.dtype.itemsize == 4:
+            vol = vol.view(np.uint8).reshape(vol.shape[0], vol.shape[1], 4)
+        return cv2.imencode(  "." + fmt, vol)[1].tostring()
 
     def get_mask(self):
         # TODO: implement this
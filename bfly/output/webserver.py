@@ -4,6 +4,7 @@ import pkg_resources
 import socket
 import tornado
 import tornado.gen
+import tornado.httpserver
 import tornado.web
 import tornado.websocket
 import numpy as np
@@ -12,11 +13,13 @@ import mimetypes
 import posixpath
 import io
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 from urllib.error import HTTPError
 from bfly.logic import settings
 from .requestparser import RequestParser
 
 from .restapi import RestAPIHandler
+from .responsecache import ResponseCache, EncodedResponse
 
 
 class WebServerHandler(tornado.web.RequestHandler):
@@ -28,7 +31,7 @@ class WebServerHandler(tornado.web.RequestHandler):
     def get(self, uri):
         '''
         '''
-        self._webserver.handle(self)
+        yield self._webserver.handle(self)
 
 
 #
@@ -63,6 +66,10 @@ class WebServer:
         '''
         self._core = core
         self._port = port
+        self._responses = ResponseCache(settings.RESPONSE_CACHE_SIZE,
+                                        settings.RESPONSE_MAX_AGE)
+        # Load and encode images off the IOLoop
+        self._executor = ThreadPoolExecutor(settings.WORKER_THREADS)
 
     def start(self):
         '''
@@ -72,7 +79,9 @@ class WebServer:
         port = self._port
 
         webapp = tornado.web.Application([
-            (r'/api/(.*)', RestAPIHandler, dict(core=self._core)),
+            (r'/api/(.*)', RestAPIHandler,
+                dict(core=self._core, responses=self._responses,
+                     executor=self._executor)),
             (r'/metainfo/(.*)', WebServerHandler, dict(webserver=self)),
             (r'/data/(.*)', WebServerHandler, dict(webserver=self)),
             (r'/stop/(.*)', WebServerHandler, dict(webserver=self)),
@@ -86,7 +95,15 @@ class WebServer:
 
         ])
 
-        webapp.listen(port, max_buffer_size=1024 * 1024 * 150000)
+        max_buffer_size = 1024 * 1024 * 150000
+        if settings.PROCESSES > 1:
+            # Fork processes sharing the port and the tile cache
+            server = tornado.httpserver.HTTPServer(
+                webapp, max_buffer_size=max_buffer_size)
+            server.bind(port)
+            server.start(settings.PROCESSES)
+        else:
+            webapp.listen(port, max_buffer_size=max_buffer_size)
         startup_msg = ('Starting webserver at \033[93mhttp://' + ip + ':' +
                        str(port) + '\033[0m')
 
@@ -122,56 +139,20 @@ class WebServer:
                 parser = RequestParser()
                 args = parser.parse(splitted_request[2:])
 
-                # Call the cutout method
-                volume = self._core.get(*args[0:3],**args[3])
-
-                # Check if we got nothing in the case of a request outside the
-                # data with fit=True
-                if volume.size == 0:
-                    raise IndexError('Tile index out of bounds')
-
-                color = parser.optional_queries['segcolor']
-
-                # Accepted image output formats
-                image_formats = settings.SUPPORTED_IMAGE_FORMATS
-
-                # Process output
-                out_dtype = np.uint8
-                output_format = parser.output_format
-
-                if output_format == 'zip' and not color:
-                    # Rotate out of numpy array
-                    volume = volume.transpose(1, 0, 2)
-                    zipped_data = zlib.compress(
-                        volume.astype(out_dtype).tostring('F'))
-
-                    output = io.StringIO()
-                    output.write(zipped_data)
-                    content = output.getvalue()
-                    content_type = 'application/octet-stream'
-                elif output_format in image_formats:
-                    if color:
-                        volume = volume[:, :, :, [2, 1, 0]]
-                        content = cv2.imencode(
-                            '.' + output_format,
-                            volume[
-                                :,
-                                :,
-                                0,
-                                :].astype(out_dtype))[1].tostring()
-                    else:
-                        content = cv2.imencode(
-                            '.' + output_format,
-                            volume[
-                                :,
-                                :,
-                                0].astype(out_dtype))[1].tostring()
-                    content_type = 'image/' + output_format
-                else:
-                    raise HTTPError(handler.request.uri,
-                                    400,
-                                    'Output file format not supported',
-                                    [], None)
+                # Reuse the encoded image for any identical request
+                queries = args[3]
+                cache_key = (args[0], tuple(args[1]), tuple(args[2]),
+                             queries['w'], queries['segcolor'],
+                             queries['fit'], parser.output_format)
+                response = self._responses.get(cache_key)
+                if response is None:
+                    response = yield self._executor.submit(
+                        self.load_response, handler.request.uri, parser,
+                        args, cache_key)
+
+                handler.set_header('Access-Control-Allow-Origin', '*')
+                self._responses.respond(handler, response)
+                return
 
                 # Show some basic statistics
 
@@ -212,3 +193,76 @@ class WebServer:
 
         # Temporary check for img output
         handler.write(content)
+
+    def load_response(self, uri, parser, args, cache_key):
+        '''
+        Send the stored file of a whole block as it is, or load,
+        encode and cache the image data for a parsed request
+        '''
+        if not parser.optional_queries['segcolor']:
+            content = self._core.get_file(*args[0:3], w=args[3]['w'],
+                                          fmt=parser.output_format)
+            if content is not None:
+                # The file is kept in the tile cache instead
+                return EncodedResponse(content,
+                                       'image/' + parser.output_format)
+        content, content_type = self.encode(uri, parser, args)
+        return self._responses.set(cache_key, content, content_type)
+
+    def encode(self, uri, parser, args):
+        '''
+        Load and encode the image data for a parsed request
+        '''
+        # Call the cutout method
+        volume = self._core.get(*args[0:3],**args[3])
+
+        # Check if we got nothing in the case of a request outside the
+        # data with fit=True
+        if volume.size == 0:
+            raise IndexError('Tile index out of bounds')
+
+        color = parser.optional_queries['segcolor']
+
+        # Accepted image output formats
+        image_formats = settings.SUPPORTED_IMAGE_FORMATS
+
+        # Process output
+        out_dtype = np.uint8
+        output_format = parser.output_format
+
+        if output_format == 'zip' and not color:
+            # Rotate out of numpy array
+            volume = volume.transpose(1, 0, 2)
+            zipped_data = zlib.compress(
+                volume.astype(out_dtype).tostring('F'))
+
+            output = io.BytesIO()
+            output.write(zipped_data)
+            content = output.getvalue()
+            content_type = 'application/octet-stream'
+        elif output_format in image_formats:
+            if color:
+                volume = volume[:, :, :, [2, 1, 0]]
+                content = cv2.imencode(
+                    '.' + output_format,
+                    volume[
+                        :,
+                        :,
+                        0,
+                        :].astype(out_dtype))[1].tostring()
+            else:
+                content = cv2.imencode(
+                    '.' + output_format,
+                    volume[
+                        :,
+                        :,
+                        0].astype(out_dtype))[1].tostring()
+            content_type = 'image/' + output_format
+        else:
+            raise HTTPError(uri,
+                            400,
+                            'Output file format not supported',
+                            [], None)
+
+        return content, content_type
+
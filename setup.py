@@ -11,7 +11,6 @@ README = open('README.md').read()
 
 INSTALL_REQ = [
     'h5py>=2.6.0',
-    'scipy>=0.17.0'
     'numpy>=1.12.0',
     'tornado>=4.4.2',
     'futures>=3.0.5',
@@ -35,5 +34,6 @@ setup(
     entry_points=dict(console_scripts=[
         'bfly = bfly.cli:main',
         'bfly_query = bfly.cli:query',
+        'bfly_pyramid = bfly.cli:pyramid',
     ])
 )